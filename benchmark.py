@@ -0,0 +1,612 @@
+'''
+Benchmarks for the coffeebot server. The benchmarks keep their files in temporary directories and log to stderr.
+
+    python benchmark.py load [--events 1000000]
+    python benchmark.py stress [--events 5000] [--clients 64] [--storage sqlite]
+    python benchmark.py poll [--events 500]
+    python benchmark.py pipeline [--users 10 100 1000 10000] [--events 1000000] [--json results.json]
+    python benchmark.py startup [--source path/to/other/checkout]
+    python benchmark.py digest [--users 100] [--events 1000]
+    python benchmark.py outbox [--chats 20] [--messages 20]
+'''
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dateutil import parser
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Request, Response
+
+import server
+
+
+def synthetic_users(n_users, n_events):
+    """Creates n_users users with n_events coffees and teas in total, spread over the last years."""
+    users = {}
+    for i in range(n_users):
+        users[str(100000 + i)] = server.User("user{0}".format(i), server.Role.admin if i == 0 else server.Role.user)
+    ids = list(users)
+    end = server.to_timestamp(datetime.datetime.now())
+    start = end - 4 * 365 * 24 * 3600 * 1000000
+    step = (end - start) // n_events
+    for i in range(n_events):
+        timestamp = start + step * i + random.randrange(step)
+        user = users[random.choice(ids)]
+        if random.random() < 0.8:
+            user.coffees.append(timestamp)
+        else:
+            user.teas.append(timestamp)
+    for user in users.values():
+        user.recount()
+    return users
+
+
+def write_legacy(path, users):
+    """Writes users in the legacy state format (ctime strings, no journal sequence number)."""
+    def encode(o):
+        d = server.CoffeeJsonEncoder().default(o)
+        if isinstance(o, server.User):
+            for key in ("coffees", "teas"):
+                d[key] = [{"_type": "datetime", "ctime": server.from_timestamp(t).ctime()} for t in d[key]]
+        return d
+    f = open(path, "w")
+    f.write(json.dumps(users, default=encode))
+    f.close()
+
+
+def write_current(path, users):
+    """Writes users in the current state format."""
+    f = open(path, "w")
+    f.write(json.dumps({"_type": "State", "seq": 0, "users": users}, cls=server.CoffeeJsonEncoder))
+    f.close()
+
+
+class DateutilJsonDecoder(server.CoffeeJsonDecoder):
+    """The decoder as it was before the fast path: every legacy timestamp goes through dateutil."""
+    def object_hook(self, obj):
+        if obj.get("_type") == "datetime":
+            return parser.parse(obj["ctime"])
+        return server.CoffeeJsonDecoder.object_hook(self, obj)
+
+
+def read_with_dateutil(path):
+    f = open(path, "r")
+    users = json.loads(f.read(), cls=DateutilJsonDecoder)
+    f.close()
+    return users
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+
+def count_events(users):
+    return sum(len(u.coffees) + len(u.teas) for u in users.values())
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def benchmark_group():
+    """Registers a group with its files in the current directory, its web-hook is /coffee/bot-benchmark."""
+    group = server.Group("benchmark", "bot-benchmark", "")
+    server.register(group)
+    return group
+
+
+class FakeTelegram:
+    """
+    A local stand-in for the telegram bot API: hands out queued updates via getUpdates and counts sent messages. Calls
+    to the chats in failures get the given error responses first.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.updates = []
+        self.sent = collections.Counter()  # chat id -> number of messages
+        self.calls = collections.Counter()  # chat id -> number of calls, including failed ones
+        self.texts = collections.defaultdict(list)  # chat id -> texts of the sent messages, in order
+        self.failures = {}  # chat id -> list of (status, response) returned for the next calls
+        self.http = make_server("127.0.0.1", 0, self.application, threaded=True)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{0}/".format(self.http.server_port)
+
+    @Request.application
+    def application(self, request):
+        method = request.path.rsplit("/", 1)[-1]
+        if method == "getUpdates":
+            call = request.get_json()
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending(call["offset"]), timeout=call["timeout"])
+                result = self.pending(call["offset"])[:call["limit"]]
+        else:
+            chat_id = request.form["chat_id"]
+            with self.condition:
+                self.calls[chat_id] += 1
+                if self.failures.get(chat_id):
+                    status, response = self.failures[chat_id].pop(0)
+                    return Response(json.dumps(response), status=status, mimetype="application/json")
+                self.sent[chat_id] += 1
+                self.texts[chat_id].append(request.form.get("text"))
+                self.condition.notify_all()
+            result = {"message_id": 1}
+        return Response(json.dumps({"ok": True, "result": result}), mimetype="application/json")
+
+    def pending(self, offset):
+        return [update for update in self.updates if update["update_id"] >= offset]
+
+    def push(self, updates):
+        with self.condition:
+            self.updates.extend(updates)
+            self.condition.notify_all()
+
+    def wait_sent(self, chat_id, n):
+        """Waits until n messages were sent to the chat. Fails if they do not arrive within a minute."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.sent[chat_id] >= n, timeout=60):
+                raise RuntimeError("expected {0} messages to {1}, got {2}".format(n, chat_id, self.sent[chat_id]))
+
+    def close(self):
+        self.http.shutdown()
+
+
+def benchmark_load(args):
+    """Compares loading a legacy state file (dateutil and fast path) to loading the current format."""
+    directory = tempfile.mkdtemp()
+    try:
+        users = synthetic_users(args.users, args.events)
+        legacy_path = os.path.join(directory, "legacy.json")
+        current_path = os.path.join(directory, "current.json")
+        write_legacy(legacy_path, users)
+        write_current(current_path, users)
+        print("state files: legacy {0:.1f} MB, current {1:.1f} MB".format(
+            os.path.getsize(legacy_path) / 1e6, os.path.getsize(current_path) / 1e6))
+        results = [("legacy, dateutil", timed(read_with_dateutil, legacy_path)),
+                   ("legacy, fast path", timed(server.read_state, legacy_path)),
+                   ("current", timed(server.read_state, current_path))]
+        for name, (seconds, result) in results:
+            loaded = result[0] if isinstance(result, tuple) else result
+            print("{0:<20} {1:8.2f} s  ({2} events)".format(name, seconds, count_events(loaded)))
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_stress(args):
+    """
+    Fires concurrent coffee and tea events at a threaded server and checks that no event is lost, neither in memory nor
+    in the state file and journal. A share of the updates is delivered twice, like telegram does after slow responses,
+    and must not be counted twice. Outgoing messages are dropped.
+    """
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        server.journal_compaction_interval = args.compaction_interval
+        server.storage_backend = args.storage
+        group = benchmark_group()
+        server.load(group)
+        server.outbox.submit = lambda *call, **kwargs: None
+        for i in range(args.users):
+            server.commit(group, {"op": "addUser", "user_id": str(100000 + i), "name": "user{0}".format(i)})
+        server.store(group)
+        http = make_server("127.0.0.1", 0, server.app, threaded=True)
+        threading.Thread(target=http.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{0}/coffee/{1}".format(http.server_port, group.bot_id)
+
+        events = [(random.choice(list(group.users)), random.choice([u"\u2615", u"\U0001F375"]))
+                  for _ in range(args.events)]
+        expected = collections.Counter(events)
+        deliveries = list(range(args.events))
+        for i in sorted(random.sample(range(args.events), int(args.events * args.redeliveries)), reverse=True):
+            deliveries.insert(i + random.randint(1, args.clients), i)  # redelivered shortly after the first delivery
+
+        def post(i):
+            user_id, text = events[i]
+            update = {"update_id": i, "message": {"from": {"id": int(user_id)}, "text": text}}
+            requests.post(url, json=update).raise_for_status()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.clients) as clients:
+            list(clients.map(post, deliveries))
+        seconds = time.perf_counter() - start
+        http.shutdown()
+        group.coalescer.flush()
+        print("{0} updates from {1} clients in {2:.2f} s ({3:.0f} updates/s)".format(
+            len(deliveries), args.clients, seconds, len(deliveries) / seconds))
+
+        def counts():
+            c = collections.Counter()
+            with group.lock:
+                for user_id in group.users:
+                    c[(user_id, u"\u2615")] = len(group.storage.events(user_id, "coffee"))
+                    c[(user_id, u"\U0001F375")] = len(group.storage.events(user_id, "tea"))
+            return +c
+
+        ok = True
+        for name in ("in memory", "reloaded from disk"):
+            if name == "reloaded from disk":
+                group.storage.close()  # without compacting, so the journal is replayed
+                server.load(group)
+            lost = sum((expected - counts()).values())
+            extra = sum((counts() - expected).values())
+            print("{0:<20} lost {1}, duplicated {2}".format(name, lost, extra))
+            ok = ok and lost == 0 and extra == 0
+        if not ok:
+            sys.exit(1)
+    finally:
+        group.storage.close()
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+# realistic web-hook traffic: message text and weight
+traffic = [(u"\u2615", 60), (u"\U0001F375", 15), (u"\u2615?", 8), (u"\U0001F375?", 3), ("more", 4), ("back", 4),
+           ("statistics", 2), (u"-\u2615", 2), (u"-\U0001F375", 1), (u"\u2615Updates [on]", 1)]
+
+
+def latency_summary(latencies):
+    """Returns count, mean, p50 and p99 of a list of latencies in seconds, in milliseconds."""
+    return {"count": len(latencies), "mean_ms": 1000 * sum(latencies) / len(latencies),
+            "p50_ms": 1000 * percentile(latencies, 50), "p99_ms": 1000 * percentile(latencies, 99)}
+
+
+def run_pipeline(n_users, args):
+    """Benchmarks the bot pipeline for one state size. Returns the results as dict."""
+    result = {"users": n_users, "events": args.events, "storage": args.storage}
+    write_current(server.state_file, synthetic_users(n_users, args.events))
+    result["state_file_bytes"] = os.path.getsize(server.state_file)
+    group = benchmark_group()
+    server.load(group)  # imports the state file into the database on first start
+    group.storage.close()
+    result["load_s"], _ = timed(server.load, group)
+
+    client = server.app.test_client()
+    url = "/coffee/" + group.bot_id
+    ids = list(group.users)
+    texts = random.choices([text for text, _ in traffic], [weight for _, weight in traffic], k=args.requests)
+    by_command = collections.defaultdict(list)
+    latencies = []
+    start = time.perf_counter()
+    for i, text in enumerate(texts):
+        update = {"update_id": i, "message": {"from": {"id": int(random.choice(ids))}, "text": text}}
+        request_start = time.perf_counter()
+        client.post(url, json=update)
+        latency = time.perf_counter() - request_start
+        latencies.append(latency)
+        by_command[server.str_to_command[text.split()[0]].name].append(latency)
+    seconds = time.perf_counter() - start
+    result["bot_request"] = dict(latency_summary(latencies), throughput=len(texts) / seconds)
+    result["commands"] = {command: latency_summary(l) for command, l in sorted(by_command.items())}
+
+    result["store_s"], _ = timed(server.store, group)
+    for plot in ("cumulative", "per_hour"):
+        result["plot_data_" + plot + "_s"], (renderer, data) = timed(server.plot_data, group, plot, "All")
+        result["render_" + plot + "_s"], _ = timed(server.plot_renderers[renderer], data, server.plot_titles[plot])
+    group.coalescer.flush()
+    group.storage.close()
+    for f in (server.state_file, server.journal_file, server.database_file):
+        if os.path.exists(f):
+            os.remove(f)
+    return result
+
+
+def benchmark_pipeline(args):
+    """
+    Replays synthetic web-hook traffic through the Flask test client for growing states. Outgoing messages are
+    dropped. Reports latency per request and command, and the time for loading, storing and rendering plots.
+    """
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        server.storage_backend = args.storage
+        server.outbox.submit = lambda *call, **kwargs: None
+        results = []
+        for n_users in args.users:
+            result = run_pipeline(n_users, args)
+            results.append(result)
+            request = result["bot_request"]
+            print("{0:>6} users: load {1:.2f} s, store {2:.2f} s, plots {3:.2f} s / {4:.2f} s, bot_request "
+                  "p50 {5:.2f} ms, p99 {6:.2f} ms ({7:.0f} requests/s)".format(
+                      n_users, result["load_s"], result["store_s"], result["render_cumulative_s"],
+                      result["render_per_hour_s"], request["p50_ms"], request["p99_ms"], request["throughput"]))
+            for command, summary in result["commands"].items():
+                print("        {0:<28} p50 {1:7.2f} ms, p99 {2:7.2f} ms ({3} requests)".format(
+                    command, summary["p50_ms"], summary["p99_ms"], summary["count"]))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+    if args.json is not None:
+        f = open(args.json, "w")
+        f.write(json.dumps({"benchmark": "pipeline", "time": datetime.datetime.now().isoformat(), "results": results},
+                           indent=2))
+        f.close()
+
+
+# run in a fresh interpreter: imports the server, loads an empty state and serves one coffee
+startup_script = """
+import json, sys, time
+start = time.perf_counter()
+import server
+imported = time.perf_counter()
+server.logger.setLevel("WARNING")
+server.outbox.submit = lambda *call, **kwargs: None
+update = {"update_id": 1, "message": {"from": {"id": 1}, "text": u"\\u2615"}}
+if hasattr(server, "Group"):
+    group = server.Group("startup", "bot-startup", "")
+    server.register(group)
+    server.load(group)
+    server.commit(group, {"op": "addUser", "user_id": "1", "name": "a"})
+    server.app.test_client().post("/coffee/" + group.bot_id, json=update)
+else:  # checkouts from before groups
+    server.load()
+    server.commit({"op": "addUser", "user_id": "1", "name": "a"})
+    server.app.test_client().post("/coffee/" + server.bot_id, json=update)
+served = time.perf_counter()
+print(json.dumps({"import_s": imported - start, "first_request_s": served - start,
+                  "heavy_modules": [m for m in ("numpy", "matplotlib", "dateutil.parser") if m in sys.modules]}))
+"""
+
+
+def benchmark_startup(args):
+    """
+    Measures the cold start of the server in fresh interpreters: time to import it and time until the first coffee is
+    served, and which heavy modules were imported until then. --source measures another checkout, e.g. an older version.
+    """
+    source = os.path.abspath(args.source)
+    results = []
+    for _ in range(args.runs):
+        directory = tempfile.mkdtemp()
+        try:
+            output = subprocess.run([sys.executable, "-c", startup_script], cwd=directory, check=True,
+                                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                    env=dict(os.environ, PYTHONPATH=source)).stdout
+            results.append(json.loads(output.decode().strip().splitlines()[-1]))
+        finally:
+            shutil.rmtree(directory)
+    print("import {0:.0f} ms, first request served after {1:.0f} ms (median of {2} runs), heavy modules loaded: {3}".format(
+        1000 * percentile([r["import_s"] for r in results], 50),
+        1000 * percentile([r["first_request_s"] for r in results], 50), args.runs,
+        ", ".join(results[-1]["heavy_modules"]) or "none"))
+
+
+def benchmark_poll(args):
+    """
+    Compares handling updates from the web-hook to getUpdates long polling, against a fake telegram API. The latency of
+    an update is the time until its answer arrives at the API; it is measured one update at a time, then the throughput
+    for a burst of all updates at once. A broken update is delivered first; the benchmark fails if answers go missing.
+    Finally the poller is stopped and started again like after a restart, from the stored offset; updates arriving in
+    between must be answered exactly once and none of the earlier ones again.
+    """
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    telegram = FakeTelegram()
+    try:
+        server.api_url = telegram.url
+        server.poll_timeout = 1
+        group = benchmark_group()
+        server.load(group)
+        for i in range(args.users):
+            server.commit(group, {"op": "addUser", "user_id": str(100000 + i), "name": "user{0}".format(i)})
+            # only count the answers to the sender
+            server.commit(group, {"op": "updatesCoffee", "user_id": str(100000 + i), "value": False})
+        http = make_server("127.0.0.1", 0, server.app, threaded=True)
+        threading.Thread(target=http.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{0}/coffee/{1}".format(http.server_port, group.bot_id)
+        session = requests.Session()
+        stop = threading.Event()
+        poller = threading.Thread(target=server.poll, args=(group, stop), daemon=True)
+        poller.start()
+        update_ids = iter(range(1, 10 ** 9))
+
+        def update(user_id):
+            return {"update_id": next(update_ids), "message": {"from": {"id": int(user_id)}, "text": u"\u2615"}}
+
+        def webhook(updates):
+            for u in updates:
+                session.post(url, json=u).raise_for_status()
+
+        for name, deliver in (("web-hook", webhook), ("polling", telegram.push)):
+            deliver([{"update_id": next(update_ids), "message": {}}])  # a broken update must not stop the handling
+            latencies = []
+            for _ in range(args.events):
+                user_id = random.choice(list(group.users))
+                expected = telegram.sent[user_id] + 1
+                start = time.perf_counter()
+                deliver([update(user_id)])
+                telegram.wait_sent(user_id, expected)
+                latencies.append(time.perf_counter() - start)
+            burst = [update(random.choice(list(group.users))) for _ in range(args.events)]
+            expected = telegram.sent + collections.Counter(str(u["message"]["from"]["id"]) for u in burst)
+            start = time.perf_counter()
+            deliver(burst)
+            for user_id, n in expected.items():
+                telegram.wait_sent(user_id, n)
+            seconds = time.perf_counter() - start
+            print("{0:<10} latency p50 {1:6.1f} ms, p99 {2:6.1f} ms; burst of {3} in {4:.2f} s ({5:.0f} updates/s)".format(
+                name, percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000, args.events, seconds,
+                args.events / seconds))
+        stop.set()
+        poller.join()
+        # restart: a new group (without the update ids seen so far) is polled from the offset stored on unloading
+        ids = list(group.users)
+        server.unload(group)
+        stored = server.create_storage(group.directory).read_offset()
+        if stored != telegram.updates[-1]["update_id"] + 1:
+            raise RuntimeError("stored offset {0}, expected {1}".format(stored, telegram.updates[-1]["update_id"] + 1))
+        waiting = [update(random.choice(ids)) for _ in range(args.events)]
+        telegram.push(waiting)  # arrive while no poller is running
+        expected = telegram.sent + collections.Counter(str(u["message"]["from"]["id"]) for u in waiting)
+        group = benchmark_group()
+        stop = threading.Event()
+        poller = threading.Thread(target=server.poll, args=(group, stop), daemon=True)
+        start = time.perf_counter()
+        poller.start()
+        for user_id, n in expected.items():
+            telegram.wait_sent(user_id, n)
+        seconds = time.perf_counter() - start
+        time.sleep(2 * server.poll_timeout)  # answers to updates handled again would have arrived by now
+        if telegram.sent != expected:
+            raise RuntimeError("{0} answers too many after the restart".format(
+                sum(telegram.sent.values()) - sum(expected.values())))
+        print("restart    resumed from offset {0}, {1} waiting updates answered once in {2:.2f} s".format(
+            stored, len(waiting), seconds))
+        stop.set()
+        poller.join()
+        http.shutdown()
+    finally:
+        telegram.close()
+        if group.storage is not None:
+            group.storage.close()
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def benchmark_digest(args):
+    """
+    Counts the messages sent for an hour of coffees and teas, with updates sent right away to every user and with hourly
+    digests. The events are taken to be further apart than the coalescing window, each one is notified on its own.
+    """
+    directory = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(directory)
+    sent = collections.Counter()  # method -> number of calls
+    server.outbox.submit = lambda bot_id, chat_id, method, data, files=None, callback=None: sent.update([method])
+    try:
+        for digest in (None, "hourly"):
+            group = benchmark_group()
+            server.load(group)
+            for i in range(args.users):
+                server.commit(group, {"op": "addUser", "user_id": str(100000 + i), "name": "user{0}".format(i)})
+                if digest is not None:
+                    server.commit(group, {"op": "digest", "user_id": str(100000 + i), "value": digest})
+            ids = list(group.users)
+            sent.clear()
+            replies = 0
+            start = datetime.datetime.now()
+            seconds = time.perf_counter()
+            for _ in range(args.events):
+                command = random.choice([server.Command.addCoffee, server.Command.addTea])
+                server.execute_command(group, command, None, random.choice(ids))
+                replies += 1
+                group.coalescer.flush()
+            if digest is not None:
+                server.send_digest(group, digest, start, datetime.datetime.now())
+            seconds = time.perf_counter() - seconds
+            print("{0:<10} {1:>7} messages ({2} replies, {3} notifications) in {4:.2f} s".format(
+                digest or "immediate", sent["sendMessage"], replies, sent["sendMessage"] - replies, seconds))
+            group.storage.close()
+            del server.groups[group.id]
+            for f in (server.state_file, server.journal_file, server.database_file):
+                if os.path.exists(f):
+                    os.remove(f)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def benchmark_outbox(args):
+    """
+    Checks the delivery of outbound calls against a fake telegram API. The first call to every chat is rate limited
+    (429 with retry_after), then fails with a server error (502), then succeeds; all messages of a chat must arrive in
+    the order they were sent. A call to a chat that blocked the bot (403) must be given up without retrying.
+    """
+    telegram = FakeTelegram()
+    server.api_url = telegram.url
+    errors, retries = server.api_errors_total.values, server.api_retries_total.values
+    errors_before, retries_before = errors[("sendMessage",)], retries[("sendMessage",)]
+    chats = [str(200000 + i) for i in range(args.chats)]
+    blocked = "299999"
+    for chat_id in chats:
+        telegram.failures[chat_id] = [
+            (429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                   "parameters": {"retry_after": 1}}),
+            (502, {"ok": False, "error_code": 502, "description": "Bad Gateway"})]
+    telegram.failures[blocked] = [(403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked"})]
+    try:
+        start = time.perf_counter()
+        for i in range(args.messages):
+            for chat_id in chats + [blocked]:
+                server.outbox.submit("bot-benchmark", chat_id, "sendMessage", {"chat_id": chat_id, "text": str(i)})
+        for chat_id in chats:
+            telegram.wait_sent(chat_id, args.messages)
+        while server.outbox.queues:
+            time.sleep(0.01)
+        seconds = time.perf_counter() - start
+        expected = [str(i) for i in range(args.messages)]
+        checks = [("messages delivered in order", all(telegram.texts[chat_id] == expected for chat_id in chats)),
+                  ("one retry after 429 and one after 502 per chat",
+                   all(telegram.calls[chat_id] == args.messages + 2 for chat_id in chats)
+                   and retries[("sendMessage",)] - retries_before == 2 * len(chats)),
+                  ("403 given up without retrying",
+                   telegram.calls[blocked] == args.messages and telegram.sent[blocked] == args.messages - 1),
+                  ("errors counted", errors[("sendMessage",)] - errors_before == 2 * len(chats) + 1)]
+        print("{0} messages to {1} chats in {2:.2f} s".format(args.messages * (len(chats) + 1), len(chats) + 1, seconds))
+        for name, ok in checks:
+            print("{0:<48} {1}".format(name, "ok" if ok else "FAILED"))
+        if not all(ok for _, ok in checks):
+            sys.exit(1)
+    finally:
+        telegram.close()
+
+
+if __name__ == "__main__":
+    server.logger.setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    argument_parser = argparse.ArgumentParser(description="coffeebot benchmarks")
+    subparsers = argument_parser.add_subparsers(dest="benchmark", required=True)
+    load_parser = subparsers.add_parser("load", help="state file loading time, legacy vs. current format")
+    load_parser.add_argument("--users", type=int, default=20)
+    load_parser.add_argument("--events", type=int, default=1000000)
+    load_parser.set_defaults(run=benchmark_load)
+    stress_parser = subparsers.add_parser("stress", help="concurrent events against a threaded server, checks for lost events")
+    stress_parser.add_argument("--users", type=int, default=50)
+    stress_parser.add_argument("--events", type=int, default=5000)
+    stress_parser.add_argument("--clients", type=int, default=64)
+    stress_parser.add_argument("--compaction-interval", type=int, default=500)
+    stress_parser.add_argument("--redeliveries", type=float, default=0.1, help="share of updates delivered twice")
+    stress_parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    stress_parser.set_defaults(run=benchmark_stress)
+    poll_parser = subparsers.add_parser("poll", help="web-hook vs. getUpdates long polling against a fake telegram API")
+    poll_parser.add_argument("--users", type=int, default=20)
+    poll_parser.add_argument("--events", type=int, default=500)
+    poll_parser.set_defaults(run=benchmark_poll)
+    pipeline_parser = subparsers.add_parser("pipeline", help="synthetic web-hook traffic for growing states")
+    pipeline_parser.add_argument("--users", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    pipeline_parser.add_argument("--events", type=int, default=1000000)
+    pipeline_parser.add_argument("--requests", type=int, default=2000)
+    pipeline_parser.add_argument("--storage", choices=["json", "sqlite"], default="json")
+    pipeline_parser.add_argument("--json", help="write the results to this file")
+    pipeline_parser.set_defaults(run=benchmark_pipeline)
+    startup_parser = subparsers.add_parser("startup", help="import time and time to the first served request")
+    startup_parser.add_argument("--source", default=os.path.dirname(os.path.abspath(__file__)),
+                                help="directory containing the server.py to measure")
+    startup_parser.add_argument("--runs", type=int, default=5)
+    startup_parser.set_defaults(run=benchmark_startup)
+    digest_parser = subparsers.add_parser("digest", help="messages sent with updates right away vs. hourly digests")
+    digest_parser.add_argument("--users", type=int, default=100)
+    digest_parser.add_argument("--events", type=int, default=1000)
+    digest_parser.set_defaults(run=benchmark_digest)
+    outbox_parser = subparsers.add_parser("outbox", help="retries, rate limits and ordering of outbound calls against a "
+                                                         "fake telegram API, fails if they do not work")
+    outbox_parser.add_argument("--chats", type=int, default=20)
+    outbox_parser.add_argument("--messages", type=int, default=20)
+    outbox_parser.set_defaults(run=benchmark_outbox)
+    arguments = argument_parser.parse_args()
+    arguments.run(arguments)
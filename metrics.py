@@ -0,0 +1,166 @@
+'''
+Prometheus-style metrics and a sampling profiler.
+
+Metrics are registered in `registry` when they are created and rendered in the Prometheus text format by `render()`.
+Labels are given as positional values, in the order of the label names the metric was created with.
+'''
+import collections
+import sys
+import threading
+import time
+
+registry = []
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+
+class Counter:
+    """A value that only goes up, per combination of label values."""
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = collections.defaultdict(float)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] += amount
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} counter".format(self.name)]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append("{0}{1} {2}".format(self.name, format_labels(self.labels, label_values), value))
+        return lines
+
+
+class Gauge:
+    """A value that is read from a function whenever the metrics are rendered."""
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        registry.append(self)
+
+    def render(self):
+        return ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} gauge".format(self.name),
+                "{0} {1}".format(self.name, self.function())]
+
+
+class Histogram:
+    """Counts observations (usually durations in seconds) in cumulative buckets, per combination of label values."""
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # label values -> [count per bucket (last one is +Inf), sum]
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            counts, _ = self.values[label_values]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self.values[label_values][1] += value
+
+    def time(self, *label_values):
+        """Returns a context manager observing the time spent in it."""
+        return Timer(self, label_values)
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation), "# TYPE {0} histogram".format(self.name)]
+        with self.lock:
+            for label_values, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append("{0}_bucket{1} {2}".format(
+                        self.name, format_labels(self.labels, label_values, [("le", bound)]), cumulative))
+                labels = format_labels(self.labels, label_values)
+                lines.append("{0}_sum{1} {2}".format(self.name, labels, total))
+                lines.append("{0}_count{1} {2}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.label_values)
+
+
+def render():
+    """Renders all registered metrics in the Prometheus text format."""
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all other threads every `interval` seconds while running. The report contains one line per
+    distinct stack (outermost frame first, separated by ";") with its number of samples, the input format of flame
+    graph tools.
+    """
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.thread = None
+        self.running = threading.Event()
+
+    def start(self):
+        """Starts sampling, unless already running. Samples of an earlier run are discarded."""
+        if self.running.is_set():
+            return
+        self.samples = collections.Counter()
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops sampling and returns the report."""
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return self.report()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while self.running.is_set():
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("{0} ({1}:{2})".format(frame.f_code.co_name, frame.f_code.co_filename.rsplit("/", 1)[-1],
+                                                        frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                self.samples[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+    def report(self):
+        return "".join("{0} {1}\n".format(stack, count) for stack, count in self.samples.most_common())
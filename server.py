@@ -1,64 +1,191 @@
-import matplotlib
-matplotlib.use('Agg')
-
+import argparse
 from flask import Flask, request, Response
 from enum import Enum
 import datetime
-import dateutil
-from dateutil import parser
 import json
 import os.path
 import logging
+import logging.handlers
 import random
 import requests
+from requests.adapters import HTTPAdapter
 import re
 import sys
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
+import metrics
 import io
+import gzip
+import hashlib
+import importlib
+import bisect
+import sqlite3
+import collections
+import atexit
+import functools
+import itertools
+import multiprocessing
+import queue
+import signal
+import tempfile
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from werkzeug.serving import make_server
+
+# matplotlib, numpy (stats) and dateutil are imported where they are needed, they are slow to import and only needed
+# for plots and unusual input; see warm_up
 
 # TODO
-# logging is not very efficient for large number of events used and can be improve
 # operations like >rename< are not necessarily sanitized, as the bot is only used with truste users at the moment
 # could use command line arguments
 
 '''
 Static settings.
 '''
+storage_backend = "json"  # "json" (state file and journal, everything in memory) or "sqlite"
 state_file = "state.json"
+journal_file = "state.journal"
+offset_file = "state.offset"  # next update id to fetch when polling, and the time of the newest event
+journal_compaction_interval = 1000  # number of journal records after which the journal is compacted into the state file
+backup_directory = "backups"  # archived snapshots and journal segments, for restoring the state as of a given time
+snapshot_interval = 3600  # seconds between the archived snapshots of each loaded group, None to disable them
+backup_snapshots = 48  # number of archived snapshots to keep, along with the journal segments since the oldest one
+database_file = "state.db"
+sqlite_batch_size = 100  # maximal number of records committed to the database at once
+coalesce_window = 1.0  # seconds during which changes are collected into one persistence flush and one notification
+update_window = 1000  # number of recent update ids remembered to drop updates telegram delivers twice
+poll_timeout = 30  # seconds a getUpdates call waits for new updates
+poll_limit = 100  # maximal number of updates fetched by one getUpdates call
+poll_workers = 4  # number of threads handling polled updates
 log_file = "coffee.log"
 coffee_response_phrases = ["KAAAFFFEEEE", "Enjoy :)"]
 tea_response_phrases = ["Splendid!", "Enjoy :)"]
 log_level = logging.DEBUG
+log_max_bytes = 10 * 1024 * 1024  # size at which the log file is rotated
+log_backup_count = 5  # number of rotated log files to keep
 bot_id = "" # set this to your bot id format "bot<numbers>:<numbers_and_text>"
-
-# if there are no users, this standard user will be created
+api_url = "https://api.telegram.org/"
+outbound_workers = 8  # number of threads sending messages to the telegram API
+outbound_retries = 3  # number of retries of a failed API call before giving up
+outbound_timeout = 10  # timeout of a single API call in seconds
+plot_cache_size = 32 * 1024 * 1024  # maximal total size of cached plots in bytes
+plot_workers = 2  # number of processes rendering plots
+plot_points = 200  # maximal number of points per user in the cumulative plot of all time
+warm_up_delay = 1.0  # seconds after start-up until the plotting modules are imported in the background, None to disable
+export_part_size = 45 * 1024 * 1024  # maximal size of an exported file, telegram accepts documents up to 50 MB
+export_chunk_size = 64 * 1024  # size of the chunks exports are read and compressed in
+metrics_port = 9090  # port of the metrics endpoint, only reachable from localhost; None to disable it
+groups_file = "groups.json"  # groups (bots) to serve, see read_groups; without it, one group uses bot_id and the files above
+groups_directory = "groups"  # the files of each configured group are kept in groups_directory/<group id>/
+group_idle_timeout = 600  # seconds without updates after which the state of a group is unloaded
+group_workers = 1  # number of worker processes the groups are partitioned across
+session_backend = "memory"  # "memory" or "redis" (shared by all processes, needs the redis package), see SessionStore
+session_ttl = 600  # seconds after which an unfinished conversation (rename, plot date choice) and its keyboard are dropped
+session_max_entries = 10000  # maximal number of sessions kept in memory, the least recently used ones are dropped first
+redis_url = "redis://localhost:6379/0"  # redis (or compatible) server keeping the sessions with session_backend = "redis"
+profiler_interval = 0.01  # seconds between two samples of the profiler
+
+# if there are no users, this standard user will be created (in the group configured by the settings above)
 defautl_user_id="" # set this to the telgram user id of your default user
 default_uesr_name="" # set this to the display name of the default user
 
 '''
-Setup Logger.
+Setup Logger. Records are only put on a queue by the logging thread; formatting and writing happen in a background
+listener thread. The log file contains one JSON object per line and is rotated by size. Only the main process and the
+worker processes write log files (see setup_logging); render processes and the benchmarks log to stderr.
 '''
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as single-line JSON objects. Attributes passed via extra=... become additional fields."""
+    standard_attributes = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {"time": datetime.datetime.fromtimestamp(record.created).isoformat(), "level": record.levelname,
+                 "thread": record.threadName, "message": record.getMessage()}
+        for key, value in record.__dict__.items():
+            if key not in self.standard_attributes:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def log_file_handler(path):
+    """Returns a handler writing JSON lines to the given file, rotated by size."""
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=log_max_bytes, backupCount=log_backup_count)
+    handler.setLevel(log_level)
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on the queue as they are. Unlike the default QueueHandler, the message is not formatted in the calling
+    thread; the queue is in-process, so records do not need to be pickled.
+    """
+    def prepare(self, record):
+        return record
+
+
 logger = logging.getLogger()
 logger.setLevel(log_level)
 
-fh = logging.FileHandler(log_file)
-fh.setLevel(log_level)
 ch = logging.StreamHandler()
 ch.setLevel(log_level)
-formatter = logging.Formatter("[%(asctime)s - %(levelname)s] %(message)s")
-fh.setFormatter(formatter)
-ch.setFormatter(formatter)
-logger.addHandler(fh)
-logger.addHandler(ch)
+ch.setFormatter(logging.Formatter("[%(asctime)s - %(levelname)s] %(message)s"))
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, ch, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
+logger.addHandler(BackgroundQueueHandler(log_queue))
+
+
+def setup_logging(path):
+    """Adds the log file at path. Each process writing (and rotating) a log file must have its own file."""
+    global log_file
+    log_file = path
+    log_listener.handlers = log_listener.handlers + (log_file_handler(path),)
 
 
 '''
-Define global variables and setup flask app.
+Define global variables and setup flask app. The state of each group is kept in its Group object.
 '''
-users = {}
+groups = {}  # group id -> Group, the groups served by this process
+groups_by_bot = {}  # bot id -> Group
+worker_queues = []  # with several worker processes: queue of the updates to each worker, see run_worker
+ring = None  # HashRing assigning the groups to the worker processes
+plot_pool = None  # process pool rendering plots, see get_plot_pool
+plot_lock = threading.Lock()
+rendering = {}  # plots currently being rendered: cache key -> users waiting for the plot
 app = Flask(__name__)
+metrics_app = Flask(__name__ + ".metrics")  # served on localhost:metrics_port only
+
+
+'''
+Metrics, see metrics.py. Gauges are computed when the metrics are requested.
+'''
+update_seconds = metrics.Histogram("coffeebot_update_seconds", "Time to handle an update.")
+stage_seconds = metrics.Histogram("coffeebot_stage_seconds", "Time spent in the stages of handling updates and "
+                                  "persisting the state.", ("stage",))
+commands_total = metrics.Counter("coffeebot_commands_total", "Commands received, including invalid ones.", ("command",))
+duplicate_updates_total = metrics.Counter("coffeebot_duplicate_updates_total", "Updates dropped as already handled.")
+update_errors_total = metrics.Counter("coffeebot_update_errors_total", "Updates that failed with an exception.")
+digests_total = metrics.Counter("coffeebot_digests_total", "Digest messages sent.", ("period",))
+api_call_seconds = metrics.Histogram("coffeebot_api_call_seconds", "Duration of telegram API calls.", ("method",))
+api_errors_total = metrics.Counter("coffeebot_api_errors_total", "Failed telegram API calls.", ("method",))
+api_retries_total = metrics.Counter("coffeebot_api_retries_total", "Retried telegram API calls.", ("method",))
+render_seconds = metrics.Histogram("coffeebot_plot_render_seconds", "Time to render a plot in a render process.",
+                                   ("plot",))
+metrics.Gauge("coffeebot_groups_loaded", "Groups whose state is loaded.", lambda: storage_stat(lambda storage: 1))
+metrics.Gauge("coffeebot_users", "Registered users of the loaded groups.",
+              lambda: sum(len(group.users) for group in list(groups.values())))
+metrics.Gauge("coffeebot_events", "Coffees and teas of the loaded groups.",
+              lambda: storage_stat(lambda storage: storage.event_count()))
+metrics.Gauge("coffeebot_state_bytes", "Size of the state of the loaded groups on disk.",
+              lambda: storage_stat(lambda storage: storage.disk_size()))
+profiler = metrics.SamplingProfiler(profiler_interval)
 
 
 '''
@@ -104,6 +231,7 @@ class Command(Enum):
     currentStateTea = 21
     changeUpdateSettingCoffee = 41
     changeUpdateSettingTea = 42
+    changeDigestSetting = 43
 
 # maps the command string to the actual command
 str_to_command = {u"\u2615": Command.addCoffee, "?": Command.currentStateCoffee, u"\u2615Updates": Command.changeUpdateSettingCoffee,
@@ -112,7 +240,7 @@ str_to_command = {u"\u2615": Command.addCoffee, "?": Command.currentStateCoffee,
                   u"-\u2615": Command.removeCoffee, "plot": Command.plot, "rename": Command.rename_start,
                   u"\U0001F375": Command.addTea, u"-\U0001F375": Command.removeTea,
                   u"\u2615?": Command.currentStateCoffee, u"\U0001F375?": Command.currentStateTea,
-                  u"\U0001F375Updates": Command.changeUpdateSettingTea}
+                  u"\U0001F375Updates": Command.changeUpdateSettingTea, "digest": Command.changeDigestSetting}
 
 # commands which need admin rights
 admin_commands = [Command.addUser, Command.broadcast, Command.getFile]
@@ -129,29 +257,194 @@ Class definitions for the application logic
 '''
 
 
+epoch = datetime.datetime(1970, 1, 1)
+HOUR = 3600 * 1000000  # in the unit of timestamps
+DAY = 24 * HOUR
+EPOCH_WEEKDAY = 3  # 1970-01-01 was a Thursday (Monday is 0)
+rollup_periods = ("day", "week", "month", "weekday_hour")
+digest_periods = ("hourly", "daily", "monthly")
+ctime_months = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+                "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+
+def to_timestamp(when):
+    """Converts a (naive, local) datetime to microseconds since the epoch. This is the on-disk time format."""
+    delta = when - epoch
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def from_timestamp(timestamp):
+    """Converts microseconds since the epoch back to a (naive, local) datetime."""
+    return epoch + datetime.timedelta(microseconds=timestamp)
+
+
+def parse_ctime(text):
+    """Parses the ctime() strings of legacy state files. Falls back to dateutil for anything unexpected."""
+    try:
+        _, month, day, time, year = text.split()
+        hour, minute, second = time.split(":")
+        return datetime.datetime(int(year), ctime_months[month], int(day), int(hour), int(minute), int(second))
+    except (ValueError, KeyError):
+        from dateutil import parser
+        return parser.parse(text)
+
+
+def decode_time(value):
+    """Decodes a time from the state file or journal to a timestamp. Legacy times are already decoded by the object hook."""
+    if isinstance(value, int):
+        return value
+    return to_timestamp(value)
+
+
+def decode_times(values):
+    """Decodes a list of times from the state file to an event array."""
+    if len(values) > 0 and not isinstance(values[0], int):
+        values = [to_timestamp(v) for v in values]
+    return array("q", values)
+
+
+def month_bounds(year, month):
+    """Returns the timestamps of the first moment of the given month and of the following month."""
+    return to_timestamp(datetime.datetime(year, month, 1)), \
+        to_timestamp(datetime.datetime(year + month // 12, month % 12 + 1, 1))
+
+
+def digest_start(period, end):
+    """Returns the start of the digest period ending at end (a full hour), or None if no such period ends then."""
+    if period == "hourly":
+        return end - datetime.timedelta(hours=1)
+    if end.hour != 0:
+        return None
+    if period == "daily":
+        return end - datetime.timedelta(days=1)
+    if end.day != 1:
+        return None
+    return (end - datetime.timedelta(days=1)).replace(day=1)
+
+
+def bucket_start(period, bucket):
+    """Returns the timestamp of the first moment of a "day", "week" (starting on Monday) or "month" bucket."""
+    if period == "day":
+        return bucket * DAY
+    elif period == "week":
+        return (bucket * 7 - EPOCH_WEEKDAY) * DAY
+    return to_timestamp(datetime.datetime(bucket // 12, bucket % 12 + 1, 1))
+
+
+def bucket_of(period, timestamp):
+    """
+    Returns the bucket of a rollup period an event falls into. Days and weeks are numbered since the epoch, months are
+    year * 12 + month - 1 and "weekday_hour" buckets are weekday * 24 + hour (Monday is 0).
+    """
+    day = timestamp // DAY
+    if period == "day":
+        return day
+    elif period == "week":
+        return (day + EPOCH_WEEKDAY) // 7
+    elif period == "month":
+        when = from_timestamp(timestamp)
+        return when.year * 12 + when.month - 1
+    return (day + EPOCH_WEEKDAY) % 7 * 24 + timestamp % DAY // HOUR
+
+
+def rollup_counts(events, period):
+    """
+    Returns the number of (sorted) events per bucket of a period. Days, weeks and months take one binary search per
+    bucket, hours of the week one vectorized pass over the events.
+    """
+    if period == "weekday_hour":
+        import stats
+        return {bucket: int(count) for bucket, count in enumerate(stats.weekday_hour_counts(events)) if count > 0}
+    counts = {}
+    first = 0
+    while first < len(events):
+        bucket = bucket_of(period, events[first])
+        last = bisect.bisect_left(events, bucket_start(period, bucket + 1), first)
+        counts[bucket] = counts.get(bucket, 0) + last - first
+        first = last
+    return counts
+
+
 class User:
     """Represents a user within the application"""
-    def __init__(self, name, role=Role.user, updates_coffee=True, updates_tea=True):
+    def __init__(self, name, role=Role.user, updates_coffee=True, updates_tea=True, digest=None):
         self.name = name
-        self.coffees = []
-        self.teas = []
+        self.coffees = array("q")  # timestamps, see to_timestamp
+        self.teas = array("q")
         self.role = role
         self.updates_coffee = updates_coffee
         self.updates_tea = updates_tea
-        self.current_keyboard = Keyboard.DEFAULT
-        self.state = UserState.DEFAULT
-
-    def add_coffee(self):
-        self.coffees.append(datetime.datetime.now())
-
-    def add_tea(self):
-        self.teas.append(datetime.datetime.now())
+        self.digest = digest  # None (updates are sent right away) or one of digest_periods
+        # number of coffees/teas per month and per hour of the week (see bucket_of, 7 * 24 counts), derived from the
+        # event arrays and therefore not stored
+        self._months = {"coffee": {}, "tea": {}}
+        self._weekday_hours = {"coffee": array("q", [0]) * (7 * 24), "tea": array("q", [0]) * (7 * 24)}
+        self._lock = threading.Lock()
+
+    @property
+    def lock(self):
+        """Lock serializing the command execution of this user."""
+        return self._lock
+
+    def add_coffee(self, timestamp):
+        self.coffees.append(timestamp)
+        self._count("coffee", timestamp, 1)
+
+    def add_tea(self, timestamp):
+        self.teas.append(timestamp)
+        self._count("tea", timestamp, 1)
 
     def remove_last_coffee(self):
-        self.coffees = self.coffees[:-1]
+        if len(self.coffees) > 0:
+            self._count("coffee", self.coffees.pop(), -1)
 
     def remove_last_tea(self):
-        self.teas = self.teas[:-1]
+        if len(self.teas) > 0:
+            self._count("tea", self.teas.pop(), -1)
+
+    def _count(self, kind, timestamp, amount):
+        months = self._months[kind]
+        month = bucket_of("month", timestamp)
+        months[month] = months.get(month, 0) + amount
+        if months[month] == 0:
+            del months[month]
+        self._weekday_hours[kind][bucket_of("weekday_hour", timestamp)] += amount
+
+    def recount(self):
+        """Rebuilds the month and hour of the week counts after the event arrays were replaced."""
+        self._months = {}
+        self._weekday_hours = {}
+        for kind in ("coffee", "tea"):
+            self._months[kind] = rollup_counts(self.events(kind), "month")
+            self._weekday_hours[kind] = array("q", [0]) * (7 * 24)
+            if len(self.events(kind)) > 0:
+                for bucket, count in rollup_counts(self.events(kind), "weekday_hour").items():
+                    self._weekday_hours[kind][bucket] = count
+
+    def copy(self):
+        """Returns a copy of the stored attributes, e.g. to serialize it without holding a lock."""
+        user = User(self.name, self.role, self.updates_coffee, self.updates_tea, self.digest)
+        user.coffees = array("q", self.coffees)
+        user.teas = array("q", self.teas)
+        return user
+
+    def events(self, kind):
+        """Returns the event array of the given kind ("coffee" or "tea")."""
+        return self.coffees if kind == "coffee" else self.teas
+
+    def rollup(self, kind, period):
+        """
+        Returns the number of events of the given kind per bucket of a rollup period, see bucket_of. The months and hours
+        of the week are kept, days and weeks are counted when asked for.
+        """
+        if period == "month":
+            return self._months[kind]
+        if period == "weekday_hour":
+            return {bucket: count for bucket, count in enumerate(self._weekday_hours[kind]) if count != 0}
+        return rollup_counts(self.events(kind), period)
+
+    def month_count(self, kind, year, month):
+        return self.rollup(kind, "month").get(year * 12 + month - 1, 0)
 
 
 '''
@@ -163,11 +456,13 @@ class CoffeeJsonEncoder(json.JSONEncoder):
     """Encode objects to JSON. Complex types get an additional _type attribute to identify them."""
     def default(self, o):
         if isinstance(o, datetime.datetime):
-            return {"_type": "datetime", "ctime": o.ctime()}
+            return to_timestamp(o)
         elif isinstance(o, User):
-            d = o.__dict__
+            d = {k: v for k, v in o.__dict__.items() if not k.startswith("_")}
             d["_type"] = "User"
             return d
+        elif isinstance(o, array):
+            return o.tolist()
         elif isinstance(o, Role):
             return {"_type": "Role", "key": o.value}
         elif isinstance(o, Enum):
@@ -186,15 +481,14 @@ class CoffeeJsonDecoder(json.JSONDecoder):
         if '_type' not in obj:
             return obj
         _type = obj["_type"]
-        if _type == "datetime":
-            return parser.parse(obj["ctime"])
+        if _type == "datetime":  # legacy format
+            return parse_ctime(obj["ctime"])
         elif _type == "User":
-            u = User(obj["name"], obj["role"], obj["updates_coffee"], obj["updates_tea"])
-            u.coffees = obj["coffees"]
+            u = User(obj["name"], obj["role"], obj["updates_coffee"], obj["updates_tea"], obj.get("digest"))
+            u.coffees = decode_times(obj["coffees"])
             if "teas" in obj:
-                u.teas = obj["teas"]
-            else:
-                u.teas = []
+                u.teas = decode_times(obj["teas"])
+            u.recount()
             return u
         elif _type == "Role":
             return Role(obj["key"])
@@ -203,97 +497,1709 @@ class CoffeeJsonDecoder(json.JSONDecoder):
 
 
 '''
-Application logic.
+Storage backends. Both persist the journal records passed to commit() and answer the queries for leaderboards and plots.
+Each group has its own storage; all methods are called while holding the lock of the group.
+'''
+
+
+def apply_record(users, record):
+    """Applies a single journal record to the given users."""
+    op = record["op"]
+    if op == "addUser":
+        users[record["user_id"]] = User(record["name"], Role(record.get("role", Role.user.value)))
+        return
+    user = users.get(record["user_id"])
+    if user is None:
+        logger.warning("journal record for unknown user: %s", record)
+    elif op == "addCoffee":
+        user.add_coffee(decode_time(record["time"]))
+    elif op == "removeCoffee":
+        user.remove_last_coffee()
+    elif op == "addTea":
+        user.add_tea(decode_time(record["time"]))
+    elif op == "removeTea":
+        user.remove_last_tea()
+    elif op == "rename":
+        user.name = record["name"]
+    elif op == "updatesCoffee":
+        user.updates_coffee = record["value"]
+    elif op == "updatesTea":
+        user.updates_tea = record["value"]
+    elif op == "digest":
+        user.digest = record["value"]
+    else:
+        logger.warning("unknown journal record: %s", record)
+
+
+def read_state(path):
+    """Reads a state file. Returns the users and the sequence number of the last journal record contained in it."""
+    f = open(path, "r+")
+    state = json.loads(f.read(), cls=CoffeeJsonDecoder)
+    f.close()
+    if state.get("_type") == "State":
+        return state["users"], state["seq"]
+    else:  # state file written before the journal existed
+        return state, 0
+
+
+def read_journal(path):
+    """Yields the records of a journal file."""
+    f = open(path, "r")
+    for line in f:
+        try:
+            yield json.loads(line, cls=CoffeeJsonDecoder)
+        except ValueError:
+            # only the last record can be incomplete (crash during write)
+            logger.warning("skipping incomplete journal record: %s", line)
+    f.close()
+
+
+def write_atomically(path, chunks):
+    """Writes a file via a temporary file, fsync and rename, so that it is either complete or unchanged after a crash."""
+    f = open(path + ".tmp", "w")
+    for chunk in chunks:
+        f.write(chunk)
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(path + ".tmp", path)
+    directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory)  # makes the rename durable
+    finally:
+        os.close(directory)
+
+
+def backup_files(directory, prefix):
+    """
+    Returns the archived files with the given prefix ("state." or "journal.") in the backup directory, as
+    (sequence number, time, path) tuples ordered by sequence number. Journal segments have no time (None).
+    """
+    files = []
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            parts = name.split(".")
+            if name.startswith(prefix) and not name.endswith(".tmp"):
+                files.append((int(parts[1]), int(parts[2]) if prefix == "state." else None, os.path.join(directory, name)))
+    return sorted(files)
+
+
+class JsonStorage:
+    """
+    Keeps all events in memory, in the users' event arrays. Every change is appended as a single line to the journal.
+    Every journal_compaction_interval records, the journal is moved to the backup directory as a segment and a snapshot
+    of the users is written to the state file in the background. The polling offset and the time of the newest event
+    are kept in the offset file, which is written after the journal has been flushed.
+    """
+    def __init__(self, state_file, journal_file, offset_file, backup_directory):
+        self.state_file = state_file
+        self.journal_file = journal_file
+        self.offset_file = offset_file
+        self.backup_directory = backup_directory
+        self.users = {}
+        self.offset = 0  # next update id to fetch when polling
+        self.newest_event = 0  # time of the newest event added, see last_event
+        self.offset_changed = False  # whether the offset file needs to be written
+        self.journal_handle = None
+        self.journal_seq = 0  # sequence number of the last record written to the journal
+        self.journal_records = 0  # number of records in the journal (since the last segment)
+        self.written_seq = 0  # sequence number of the last record contained in the state file
+        self.snapshot_lock = threading.Lock()  # serializes writing snapshots
+        self.writers = []  # threads writing snapshots in the background
+
+    def load(self):
+        """Loads the state file and replays all journal records written after it. Returns the users."""
+        loaded = {}
+        seq = 0
+        if os.path.exists(self.state_file):
+            logger.info("Found existing state file. Loading.")
+            loaded, seq = read_state(self.state_file)
+        self.written_seq = seq
+        # there are segments newer than the state file if the process stopped before their snapshot was written
+        journals = [path for last_seq, _, path in backup_files(self.backup_directory, "journal.") if last_seq > seq]
+        if os.path.exists(self.journal_file):
+            journals.append(self.journal_file)
+        replayed = 0
+        for path in journals:
+            for record in read_journal(path):
+                if record["seq"] <= seq:  # already contained in the state file
+                    continue
+                apply_record(loaded, record)
+                seq = record["seq"]
+                replayed += 1
+        if replayed > 0:
+            logger.info("Replayed %s journal records.", replayed)
+        self.journal_seq = seq
+        self.journal_records = replayed
+        self.offset, stored_newest = self.read_offset_file()
+        self.newest_event = max((events[-1] for user in loaded.values() for events in (user.coffees, user.teas)
+                                 if events), default=0)
+        self.offset_changed = stored_newest != self.newest_event  # e.g. offset files written before it was stored
+        self.users = loaded
+        return loaded
+
+    def read_offset_file(self):
+        """Returns the polling offset and the time of the newest event (None if not stored) from the offset file."""
+        if not os.path.exists(self.offset_file):
+            return 0, None
+        f = open(self.offset_file, "r")
+        values = f.read().split()
+        f.close()
+        return int(values[0]) if values else 0, int(values[1]) if len(values) > 1 else None
+
+    def read_offset(self):
+        """Returns the stored polling offset. Does not need the state to be loaded."""
+        return self.read_offset_file()[0]
+
+    def read_last_event(self):
+        """Returns the stored time of the newest event (see last_event), None if unknown. Does not need the state."""
+        return self.read_offset_file()[1]
+
+    def commit(self, record):
+        """Applies a record to the users and appends it to the journal. Compacts the journal periodically."""
+        apply_record(self.users, record)
+        if record["op"] in ("addCoffee", "addTea") and decode_time(record["time"]) > self.newest_event:
+            self.newest_event = decode_time(record["time"])
+            self.offset_changed = True
+        self.journal_seq += 1
+        record["seq"] = self.journal_seq
+        if self.journal_handle is None:
+            self.journal_handle = open(self.journal_file, "a")
+        self.journal_handle.write(json.dumps(record, cls=CoffeeJsonEncoder, separators=(",", ":")) + "\n")
+        self.journal_records += 1
+        if self.journal_records >= journal_compaction_interval:
+            self.writers = [writer for writer in self.writers if writer.is_alive()]
+            writer = threading.Thread(target=self.write_snapshot, args=(self.snapshot(),), name="snapshot", daemon=True)
+            writer.start()
+            self.writers.append(writer)
+
+    def set_offset(self, offset):
+        """Sets the polling offset, it is written on the next flush."""
+        self.offset = offset
+        self.offset_changed = True
+
+    def flush(self):
+        """Writes buffered journal records to the journal file, then the offset file."""
+        if self.journal_handle is not None:
+            self.journal_handle.flush()
+        if self.offset_changed:
+            f = open(self.offset_file + ".tmp", "w")
+            f.write("{0}\n{1}\n".format(self.offset, self.newest_event))
+            f.close()
+            os.replace(self.offset_file + ".tmp", self.offset_file)
+            self.offset_changed = False
+
+    def rotate(self):
+        """Closes the journal and moves it to the backup directory, as segment named by its last sequence number."""
+        if self.journal_handle is not None:
+            self.journal_handle.close()
+            self.journal_handle = None
+        if os.path.exists(self.journal_file) and os.path.getsize(self.journal_file) > 0:
+            os.makedirs(self.backup_directory, exist_ok=True)
+            os.replace(self.journal_file, os.path.join(self.backup_directory, "journal.{0:012d}".format(self.journal_seq)))
+        self.journal_records = 0
+
+    def snapshot(self):
+        """
+        Starts a new journal segment and returns a copy of the users as (sequence number, time, users), to be written
+        by write_snapshot without holding the lock. Copying the event arrays is much faster than serializing them.
+        """
+        self.rotate()
+        return self.journal_seq, to_timestamp(datetime.datetime.now()), \
+            {user_id: user.copy() for user_id, user in self.users.items()}
+
+    def write_snapshot(self, snapshot, archive=False):
+        """
+        Writes a snapshot to the state file (unless a newer one was written already) and, if archive is set, to the
+        backup directory. Then deletes the backups which are not needed any more.
+        """
+        seq, taken, users = snapshot
+        text = json.dumps({"_type": "State", "seq": seq, "time": taken, "users": users}, cls=CoffeeJsonEncoder)
+        with self.snapshot_lock, stage_seconds.time("snapshot"):
+            if archive:
+                os.makedirs(self.backup_directory, exist_ok=True)
+                write_atomically(os.path.join(self.backup_directory, "state.{0:012d}.{1}.json".format(seq, taken)),
+                                 [text])
+            if seq >= self.written_seq:
+                write_atomically(self.state_file, [text])
+                self.written_seq = seq
+            self.prune()
+
+    def prune(self):
+        """Deletes the archived snapshots beyond backup_snapshots and the journal segments before the oldest snapshot."""
+        snapshots = backup_files(self.backup_directory, "state.")
+        kept = snapshots[-backup_snapshots:]
+        for _, _, path in snapshots[:len(snapshots) - len(kept)]:
+            os.remove(path)
+        oldest = min(kept[0][0], self.written_seq) if kept else self.written_seq
+        for last_seq, _, path in backup_files(self.backup_directory, "journal."):
+            if last_seq <= oldest:
+                os.remove(path)
+
+    def compact(self):
+        """Writes the users to the state file and starts a new journal segment."""
+        self.flush()
+        self.write_snapshot(self.snapshot())
+
+    def restore(self, when):
+        """
+        Replaces the state by the state as of the given timestamp: the newest archived snapshot taken before it, with
+        the journal records committed until then. The current state is archived first, so it can be restored as well.
+        Returns the time of the snapshot and the number of replayed records.
+        """
+        self.load()
+        self.write_snapshot(self.snapshot(), archive=True)
+        snapshots = [snapshot for snapshot in backup_files(self.backup_directory, "state.") if snapshot[1] <= when]
+        if not snapshots:
+            raise ValueError("there is no snapshot before {0}".format(from_timestamp(when)))
+        seq, taken, path = snapshots[-1]
+        users, _ = read_state(path)
+        replayed = 0
+        # sequence numbers increase with the commit time, also across restores (see below), so the records can be
+        # replayed in order until the first one after the given time
+        records = (record for last_seq, _, segment in backup_files(self.backup_directory, "journal.") if last_seq > seq
+                   for record in read_journal(segment))
+        for record in records:
+            if record["seq"] <= seq:
+                continue
+            if record.get("at", when) > when:
+                break
+            apply_record(users, record)
+            replayed += 1
+        # the restored state keeps the current sequence number, so the records after it do not collide with the
+        # records of the state it replaces
+        self.users = users
+        self.write_snapshot(self.snapshot(), archive=True)
+        return taken, replayed
+
+    def month_count(self, user_id, kind, year, month):
+        return self.users[user_id].month_count(kind, year, month)
+
+    def rollup(self, user_id, kind, period):
+        """Returns the number of the user's events of the given kind per bucket of a rollup period, see bucket_of."""
+        return dict(self.users[user_id].rollup(kind, period))
+
+    def event_count(self):
+        return sum(len(user.coffees) + len(user.teas) for user in self.users.values())
+
+    def event_counts(self, kind, start, end):
+        """Returns the number of events of the given kind in [start, end) per user, for the users with any."""
+        counts = {}
+        for user_id, user in self.users.items():
+            events = user.events(kind)
+            count = bisect.bisect_left(events, end) - bisect.bisect_left(events, start)
+            if count > 0:
+                counts[user_id] = count
+        return counts
+
+    def last_event(self):
+        """
+        Returns the time of the newest coffee or tea, 0 if there is none. Removals are not taken into account until the
+        next load, so it may be newer.
+        """
+        return self.newest_event
+
+    def disk_size(self):
+        """Returns the size of the state file and journal in bytes."""
+        return sum(os.path.getsize(f) for f in (self.state_file, self.journal_file) if os.path.exists(f))
+
+    def events(self, user_id, kind, start=None, end=None):
+        """Returns a copy of the user's events of the given kind in [start, end) as array('q')."""
+        events = self.users[user_id].events(kind)
+        first = 0 if start is None else bisect.bisect_left(events, start)
+        last = len(events) if end is None else bisect.bisect_left(events, end)
+        return events[first:last]
+
+    def close(self):
+        for writer in self.writers:
+            writer.join()
+        if self.journal_handle is not None:
+            self.journal_handle.close()
+            self.journal_handle = None
+
+
+class SqliteStorage:
+    """
+    Keeps the events in a SQLite database (WAL mode), indexed by (user_id, kind, ts), and their rollups in the rollups
+    table, updated with every event. Only the users themselves are kept in memory. Changes are committed on flush, or
+    after sqlite_batch_size records. The polling offset and the time of the newest event are kept in the meta table and
+    committed together with the changes. On first start, an existing state file (and journal) is imported. Archived
+    snapshots are online backups of the whole database; the records since the oldest one are kept in the journal table,
+    for restoring.
+    """
+    def __init__(self, database_file, state_file, journal_file, offset_file, backup_directory):
+        self.database_file = database_file
+        self.json_files = (state_file, journal_file, offset_file, backup_directory)  # imported on first start
+        self.backup_directory = backup_directory
+        self.users = {}
+        self.connection = None
+        self.pending = 0  # records not committed yet
+        self.offset = 0  # next update id to fetch when polling
+        self.events_total = 0  # number of events, kept up to date by commit (counting the table takes a full scan)
+        self.newest_event = 0  # time of the newest event added, see last_event
+
+    def load(self):
+        """Opens the database and loads the users (without their events). Imports the JSON state on first start."""
+        self.connection = sqlite3.connect(self.database_file, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, name TEXT, role INTEGER, "
+                                "updates_coffee INTEGER, updates_tea INTEGER, digest TEXT)")
+        if "digest" not in [column[1] for column in self.connection.execute("PRAGMA table_info(users)")]:
+            self.connection.execute("ALTER TABLE users ADD COLUMN digest TEXT")  # databases created before digests
+        self.connection.execute("CREATE TABLE IF NOT EXISTS events (user_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                                "ts INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS events_by_user ON events (user_id, kind, ts)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS rollups (user_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                                "period TEXT NOT NULL, bucket INTEGER NOT NULL, count INTEGER NOT NULL, "
+                                "PRIMARY KEY (user_id, kind, period, bucket)) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS journal (seq INTEGER PRIMARY KEY, at INTEGER NOT NULL, "
+                                "record TEXT NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.connection.commit()
+        if self.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0 and \
+                (os.path.exists(self.json_files[0]) or os.path.exists(self.json_files[1])):
+            self.import_json()
+        if self.connection.execute("SELECT COUNT(*) FROM rollups").fetchone()[0] == 0 and \
+                self.connection.execute("SELECT 1 FROM events LIMIT 1").fetchone() is not None:
+            self.build_rollups()
+        self.events_total = self.connection.execute("SELECT COALESCE(SUM(count), 0) FROM rollups "
+                                                    "WHERE period = 'month'").fetchone()[0]
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'offset'").fetchone()
+        self.offset = 0 if row is None else row[0]
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'last_event'").fetchone()
+        if row is None:  # after an import, or databases created before it was stored
+            # per user and kind, the maximum is read from the index; MAX(ts) of all events scans the whole table
+            newest = "SELECT MAX(ts) FROM events WHERE user_id = ? AND kind = ?"
+            self.newest_event = max((self.connection.execute(newest, (user_id, kind)).fetchone()[0] or 0
+                                     for (user_id,) in self.connection.execute("SELECT user_id FROM users").fetchall()
+                                     for kind in ("coffee", "tea")), default=0)
+            self.connection.execute("INSERT INTO meta VALUES ('last_event', ?)", (self.newest_event,))
+            self.connection.commit()
+        else:
+            self.newest_event = row[0]
+        loaded = {}
+        for user_id, name, role, updates_coffee, updates_tea, digest in self.connection.execute(
+                "SELECT user_id, name, role, updates_coffee, updates_tea, digest FROM users"):
+            loaded[user_id] = User(name, Role(role), bool(updates_coffee), bool(updates_tea), digest)
+        logger.info("Loaded %s users from the database.", len(loaded))
+        self.users = loaded
+        return loaded
+
+    def read_meta(self, key):
+        """Returns a value of the meta table, None if it is not there. Does not need the database to be loaded."""
+        connection = sqlite3.connect(self.database_file)
+        try:
+            row = connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        except sqlite3.OperationalError:  # no meta table yet
+            row = None
+        finally:
+            connection.close()
+        return None if row is None else row[0]
+
+    def read_offset(self):
+        """Returns the stored polling offset. Does not need the database to be loaded."""
+        if not os.path.exists(self.database_file):
+            return JsonStorage(*self.json_files).read_offset()  # imported on first start
+        return self.read_meta("offset") or 0
+
+    def read_last_event(self):
+        """Returns the stored time of the newest event (see last_event), None if unknown. Does not need the database."""
+        if not os.path.exists(self.database_file):
+            return JsonStorage(*self.json_files).read_last_event()
+        return self.read_meta("last_event")
+
+    def import_json(self):
+        """Imports the state file and journal of the JSON storage."""
+        logger.info("Importing %s into the database.", self.json_files[0])
+        json_storage = JsonStorage(*self.json_files)
+        imported = json_storage.load()
+        for user_id, user in imported.items():
+            self.write_user(user_id, user)
+            for kind in ("coffee", "tea"):
+                self.connection.executemany("INSERT INTO events VALUES (?, ?, ?)",
+                                            ((user_id, kind, ts) for ts in user.events(kind)))
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('offset', ?)", (json_storage.offset,))
+        self.connection.commit()
+
+    def build_rollups(self):
+        """Computes the rollups of all events, after an import or for databases created before rollups existed."""
+        logger.info("Computing the rollups of %s events.",
+                    self.connection.execute("SELECT COUNT(*) FROM events").fetchone()[0])
+        for user_id, kind in self.connection.execute("SELECT DISTINCT user_id, kind FROM events").fetchall():
+            events = self.events(user_id, kind)
+            self.connection.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?)",
+                                        ((user_id, kind, period, bucket, count) for period in rollup_periods
+                                         for bucket, count in rollup_counts(events, period).items()))
+        self.connection.commit()
+
+    def update_rollups(self, user_id, kind, timestamp, amount):
+        self.connection.executemany("INSERT INTO rollups VALUES (?, ?, ?, ?, ?) ON CONFLICT (user_id, kind, period, "
+                                    "bucket) DO UPDATE SET count = count + excluded.count",
+                                    [(user_id, kind, period, bucket_of(period, timestamp), amount)
+                                     for period in rollup_periods])
+
+    def write_user(self, user_id, user):
+        self.connection.execute("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?)",
+                                (user_id, user.name, user.role.value, user.updates_coffee, user.updates_tea, user.digest))
+
+    def commit(self, record):
+        """Applies a record to the database (and the users, for anything but events)."""
+        op = record["op"]
+        user_id = record["user_id"]
+        if op in ("addCoffee", "addTea"):
+            kind = "coffee" if op == "addCoffee" else "tea"
+            timestamp = decode_time(record["time"])
+            self.connection.execute("INSERT INTO events VALUES (?, ?, ?)", (user_id, kind, timestamp))
+            self.update_rollups(user_id, kind, timestamp, 1)
+            self.events_total += 1
+            if timestamp > self.newest_event:
+                self.newest_event = timestamp
+                self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('last_event', ?)", (timestamp,))
+        elif op in ("removeCoffee", "removeTea"):
+            kind = "coffee" if op == "removeCoffee" else "tea"
+            row = self.connection.execute("SELECT rowid, ts FROM events WHERE user_id = ? AND kind = ? "
+                                          "ORDER BY ts DESC, rowid DESC LIMIT 1", (user_id, kind)).fetchone()
+            if row is not None:
+                self.connection.execute("DELETE FROM events WHERE rowid = ?", (row[0],))
+                self.update_rollups(user_id, kind, row[1], -1)
+                self.events_total -= 1
+        else:
+            apply_record(self.users, record)
+            if op == "addUser":  # a user added again starts from scratch
+                self.events_total -= self.connection.execute("DELETE FROM events WHERE user_id = ?", (user_id,)).rowcount
+                self.connection.execute("DELETE FROM rollups WHERE user_id = ?", (user_id,))
+            if user_id in self.users:
+                self.write_user(user_id, self.users[user_id])
+        if "at" in record:
+            self.connection.execute("INSERT INTO journal (at, record) VALUES (?, ?)",
+                                    (record["at"], json.dumps(record, separators=(",", ":"))))
+        self.pending += 1
+        if self.pending >= sqlite_batch_size:
+            self.flush()
+
+    def set_offset(self, offset):
+        """Sets the polling offset, it is committed with the next batch."""
+        self.offset = offset
+        self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('offset', ?)", (offset,))
+        self.pending += 1
+
+    def flush(self):
+        """Commits all pending records."""
+        if self.pending > 0:
+            self.connection.commit()
+            self.pending = 0
+
+    def compact(self):
+        """Commits pending records and checkpoints the write-ahead log into the database file."""
+        self.flush()
+        self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def snapshot(self):
+        """
+        Deletes the journal records before the oldest backup and commits. Returns the time of the snapshot, the backup
+        is made by write_snapshot.
+        """
+        backups = self.backups()[-backup_snapshots:]
+        if backups:
+            self.connection.execute("DELETE FROM journal WHERE at < ?", (backups[0][0],))
+            self.pending += 1
+        self.flush()
+        return to_timestamp(datetime.datetime.now())
+
+    def write_snapshot(self, taken, archive=False):
+        """
+        Copies the database to the backup directory if archive is set (the database itself is always up to date).
+        The copy is read through a connection of its own, in steps, so changes can be committed in the meantime.
+        """
+        if not archive:
+            return
+        os.makedirs(self.backup_directory, exist_ok=True)
+        path = os.path.join(self.backup_directory, "database.{0}.db".format(taken))
+        with stage_seconds.time("snapshot"):
+            source = sqlite3.connect(self.database_file)
+            target = sqlite3.connect(path + ".tmp")
+            source.backup(target, pages=1024)
+            target.close()
+            source.close()
+        os.replace(path + ".tmp", path)
+        for _, old in self.backups()[:-backup_snapshots]:
+            os.remove(old)
+
+    def backups(self):
+        """Returns the archived databases as (time, path) pairs, oldest first."""
+        backups = []
+        if os.path.isdir(self.backup_directory):
+            for name in os.listdir(self.backup_directory):
+                if name.startswith("database.") and name.endswith(".db"):
+                    backups.append((int(name.split(".")[1]), os.path.join(self.backup_directory, name)))
+        return sorted(backups)
+
+    def restore(self, when):
+        """
+        Replaces the database by the newest backup taken before the given timestamp, with the journal records committed
+        until then. The current database is backed up first, so it can be restored as well. Returns the time of the
+        backup and the number of replayed records.
+        """
+        self.load()
+        self.write_snapshot(self.snapshot(), archive=True)
+        backups = [backup for backup in self.backups() if backup[0] <= when]
+        if not backups:
+            raise ValueError("there is no snapshot before {0}".format(from_timestamp(when)))
+        taken, path = backups[-1]
+        # the records are read from the first backup after the given time, as the current database lacks them if
+        # another restore happened since
+        later = [backup for backup in self.backups() if backup[0] > when]
+        source = sqlite3.connect(later[0][1]) if later else self.connection
+        records = [json.loads(row[0]) for row in source.execute(
+            "SELECT record FROM journal WHERE at > ? AND at <= ? ORDER BY seq", (taken, when))]
+        if later:
+            source.close()
+        self.close()
+        for f in (self.database_file + "-wal", self.database_file + "-shm", self.database_file):
+            if os.path.exists(f):
+                os.remove(f)
+        source = sqlite3.connect(path)
+        target = sqlite3.connect(self.database_file)
+        source.backup(target)
+        target.close()
+        source.close()
+        self.load()
+        for record in records:
+            self.commit(record)
+        self.close()
+        return taken, len(records)
+
+    def month_count(self, user_id, kind, year, month):
+        row = self.connection.execute("SELECT count FROM rollups WHERE user_id = ? AND kind = ? AND period = 'month' "
+                                      "AND bucket = ?", (user_id, kind, year * 12 + month - 1)).fetchone()
+        return 0 if row is None else row[0]
+
+    def rollup(self, user_id, kind, period):
+        """Returns the number of the user's events of the given kind per bucket of a rollup period, see bucket_of."""
+        return dict(self.connection.execute("SELECT bucket, count FROM rollups WHERE user_id = ? AND kind = ? AND "
+                                            "period = ? AND count > 0", (user_id, kind, period)))
+
+    def event_count(self):
+        return self.events_total
+
+    def event_counts(self, kind, start, end):
+        """Returns the number of events of the given kind in [start, end) per user, for the users with any."""
+        counts = {}
+        for user_id in self.users:  # one range of the index per user
+            count = self.connection.execute("SELECT COUNT(*) FROM events WHERE user_id = ? AND kind = ? AND ts >= ? "
+                                            "AND ts < ?", (user_id, kind, start, end)).fetchone()[0]
+            if count > 0:
+                counts[user_id] = count
+        return counts
+
+    def last_event(self):
+        """
+        Returns the time of the newest coffee or tea, 0 if there is none. Removals are not taken into account, so it may
+        be newer.
+        """
+        return self.newest_event
+
+    def disk_size(self):
+        """Returns the size of the database and its write-ahead log in bytes."""
+        return sum(os.path.getsize(f) for f in (self.database_file, self.database_file + "-wal") if os.path.exists(f))
+
+    def events(self, user_id, kind, start=None, end=None):
+        """Returns the user's events of the given kind in [start, end) as array('q')."""
+        cursor = self.connection.execute("SELECT ts FROM events WHERE user_id = ? AND kind = ? AND ts >= ? AND ts < ? "
+                                         "ORDER BY ts", (user_id, kind, -2 ** 63 if start is None else start,
+                                                         2 ** 63 - 1 if end is None else end))
+        return array("q", (row[0] for row in cursor))
+
+    def close(self):
+        if self.connection is not None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
+
+
+'''
+Outbound delivery. Messages are sent to the telegram API in the background, so web-hook calls return right away.
+'''
+
+
+class Outbox:
+    """
+    Sends API calls on a bounded pool of worker threads sharing one keep-alive session.
+    Calls to the same chat (of a bot) are delivered in order, calls to different chats concurrently.
+    """
+    def __init__(self, workers):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox")
+        self.lock = threading.Lock()
+        # (bot id, chat id) -> calls not yet delivered; a chat is in here while a worker is draining it
+        self.queues = {}
+
+    def submit(self, bot_id, chat_id, method, data, files=None, callback=None, done=None):
+        """
+        Queues an API call of a bot. The callback is called with the API result once the call succeeded, done (if given)
+        with whether it succeeded once it was delivered or given up.
+        """
+        call = (method, data, files, callback)
+        with self.lock:
+            if (bot_id, chat_id) in self.queues:
+                self.queues[(bot_id, chat_id)].append((call, done))
+                return
+            self.queues[(bot_id, chat_id)] = collections.deque([(call, done)])
+        self.executor.submit(self.drain, bot_id, chat_id)
+
+    def drain(self, bot_id, chat_id):
+        """Delivers all queued calls of a chat, one after another."""
+        while True:
+            with self.lock:
+                queue = self.queues[(bot_id, chat_id)]
+                if not queue:
+                    del self.queues[(bot_id, chat_id)]
+                    return
+                call, done = queue.popleft()
+            try:
+                delivered = self.deliver(bot_id, chat_id, *call)
+            except Exception:
+                logger.exception("unexpected error when delivering %s to %s", call[0], chat_id)
+                delivered = False
+            if done is not None:
+                done(delivered)
+
+    def deliver(self, bot_id, chat_id, method, data, files, callback):
+        """
+        Performs a single API call, returns whether it succeeded. Retries on network and server errors and respects rate
+        limits. Other client errors (e.g. 403 from a user who blocked the bot, 400 for bad markup) are not retried.
+        """
+        for attempt in range(outbound_retries + 1):
+            if attempt > 0:
+                api_retries_total.inc(method)
+            for _, content in (files or {}).values():
+                if hasattr(content, "seek"):
+                    content.seek(0)  # uploads from files start over on retries
+            try:
+                with api_call_seconds.time(method):
+                    response = self.session.post(url=api_url + bot_id + "/" + method, data=data, files=files,
+                                                 timeout=outbound_timeout)
+                    result = response.json()
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("API call %s to %s failed: %s", method, chat_id, e)
+                api_errors_total.inc(method)
+                time.sleep(2 ** attempt)
+                continue
+            if response.status_code >= 400:
+                api_errors_total.inc(method)
+            if response.status_code == 429:  # rate limited, telegram tells us how long to wait
+                retry_after = result.get("parameters", {}).get("retry_after", 2 ** attempt)
+                logger.info("rate limited when sending to %s, retrying after %ss", chat_id, retry_after)
+                time.sleep(retry_after)
+                continue
+            if response.status_code >= 500:
+                logger.warning("API call %s to %s failed: %s", method, chat_id, result)
+                time.sleep(2 ** attempt)
+                continue
+            if response.status_code >= 400:
+                logger.warning("API call %s to %s rejected: %s", method, chat_id, result)
+                return False
+            logger.debug("got response from API", extra={"response": result})
+            if callback is not None and result.get("ok"):
+                callback(result["result"])
+            return True
+        logger.error("giving up on API call %s to %s", method, chat_id)
+        return False
+
+    def close(self):
+        """Waits until all queued calls are delivered."""
+        self.executor.shutdown(wait=True)
+
+
+outbox = Outbox(outbound_workers)
+poll_handlers = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="poll")  # shared by all pollers
+
+
+def create_storage(directory=""):
+    """Creates the storage backend selected by storage_backend, with its files in the given directory."""
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    json_files = [os.path.join(directory, f) for f in (state_file, journal_file, offset_file, backup_directory)]
+    if storage_backend == "sqlite":
+        return SqliteStorage(os.path.join(directory, database_file), *json_files)
+    return JsonStorage(*json_files)
+
+
+def storage_stat(function):
+    """Sums function(storage) over the loaded groups."""
+    total = 0
+    for group in list(groups.values()):
+        with group.lock:
+            if group.storage is not None:
+                total += function(group.storage)
+    return total
+
+
+'''
+Cache for rendered plots.
+'''
+
+
+class CachedPlot:
+    """A rendered plot and, once it has been uploaded, the file id telegram assigned to it."""
+    def __init__(self, png, pinned):
+        self.png = png
+        self.pinned = pinned
+        self.file_id = None
+
+    def uploaded(self, result):
+        """Remembers the file id of an uploaded plot, so it can be re-sent without uploading it again."""
+        self.file_id = result["photo"][-1]["file_id"]
+
+
+class PlotCache:
+    """
+    LRU cache of rendered plots, limited by the total size of the images.
+    Pinned plots (closed months) are never evicted, but replace older versions of the same plot.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = collections.OrderedDict()  # key -> CachedPlot, least recently used first
+        self.pinned = {}  # key without version -> key of the pinned entry
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached is not None:
+                self.entries.move_to_end(key)
+            return cached
+
+    def put(self, key, png, pinned=False):
+        cached = CachedPlot(png, pinned)
+        with self.lock:
+            if key in self.entries:
+                self.remove(key)
+            if pinned:
+                if key[:-1] in self.pinned:
+                    self.remove(self.pinned[key[:-1]])
+                self.pinned[key[:-1]] = key
+            self.entries[key] = cached
+            self.size += len(png)
+            for k in [k for k, v in self.entries.items() if not v.pinned]:
+                if self.size <= self.max_bytes:
+                    break
+                self.remove(k)
+        return cached
+
+    def remove(self, key):
+        cached = self.entries.pop(key)
+        self.size -= len(cached.png)
+        if cached.pinned:
+            del self.pinned[key[:-1]]
+
+    def drop(self, group_id):
+        """Removes all plots of a group (keys start with the group id)."""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == group_id]:
+                self.remove(key)
+
+
+plot_cache = PlotCache(plot_cache_size)
+
+
+'''
+Plot rendering. Runs in worker processes, so the functions only get plain data: a list of (name, events) pairs.
+'''
+
+
+def render_cumulative(data, title):
+    """Renders the cumulative coffee count of all users. Returns the PNG image or None if there is no data."""
+    import stats
+    return cumulative_figure([(name, stats.times(coffees), stats.cumulative_counts(coffees))
+                              for name, coffees in data if len(coffees) > 0], title)
+
+
+def render_cumulative_rollup(data, title):
+    """Renders the cumulative coffee count from (name, times, counts) series, see cumulative_series."""
+    import stats
+    return cumulative_figure([(name, stats.times(times), counts) for name, times, counts in data if len(times) > 0],
+                             title)
+
+
+def cumulative_figure(series, title):
+    """Plots (name, times, cumulative counts) series. Returns the PNG image or None if there are none."""
+    from matplotlib.figure import Figure
+    if not series:
+        return None
+    figure = Figure(figsize=(8.5, 6))
+    axes = figure.add_subplot()
+    for name, times, counts in series:
+        axes.plot(times, counts, label=name)
+    handles, labels = axes.get_legend_handles_labels()
+    axes.legend(handles[::-1], labels[::-1], bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+    axes.set_title(title)
+    axes.set(ylabel='#coffees')
+    axes.set(xlabel='date')
+    figure.autofmt_xdate()
+
+    figure.subplots_adjust(right=0.8, bottom=0.2)
+
+    buf = io.BytesIO()
+    figure.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+def render_per_hour(data, title):
+    """Renders the coffees of all users by day of week and time of day. Returns the PNG image or None if there is no data."""
+    import stats
+    return per_hour_figure([(name,) + stats.weekday_and_hour(coffees) + (None,)
+                            for name, coffees in data if len(coffees) > 0], title)
+
+
+def render_per_hour_rollup(data, title):
+    """
+    Renders (name, coffees per hour of the week) pairs, see plot_data. Every hour with coffees is one marker, sized by
+    the number of coffees. The users are placed side by side within the column of a day.
+    """
+    largest = max([max(counts) for _, counts in data] + [0])
+    points = []
+    for i, (name, counts) in enumerate(data):
+        offset = 0.6 * (i / (len(data) - 1) - 0.5) if len(data) > 1 else 0
+        hours = [bucket for bucket in range(7 * 24) if counts[bucket] > 0]
+        if hours:
+            points.append((name, [bucket // 24 + offset for bucket in hours], [bucket % 24 for bucket in hours],
+                           [20 + 180 * counts[bucket] / largest for bucket in hours]))
+    return per_hour_figure(points, title)
+
+
+def per_hour_figure(points, title):
+    """Plots (name, weekdays, hours, marker sizes) points. Returns the PNG image or None if there are none."""
+    from matplotlib.figure import Figure
+    if not points:
+        return None
+    figure = Figure(figsize=(8.5, 6))
+    axes = figure.add_subplot()
+    for name, weekdays, hours, sizes in points:
+        axes.scatter(weekdays, hours, s=sizes, marker="x", label=name)
+    handles, labels = axes.get_legend_handles_labels()
+    axes.legend(handles[::-1], labels[::-1], bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
+    axes.set_title(title)
+    axes.set(ylabel="time of day")
+    axes.set(xlabel="day of week")
+    axes.set_ylim([0, 23])
+    axes.set_xticks(range(7))
+    axes.set_xticklabels(['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'], rotation='vertical')
+    axes.set_yticks(range(24))
+    axes.invert_yaxis()
+
+    figure.subplots_adjust(right=0.8, bottom=0.2)
+
+    buf = io.BytesIO()
+    figure.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+plot_renderers = {"cumulative": render_cumulative, "per_hour": render_per_hour,
+                  "cumulative_rollup": render_cumulative_rollup, "per_hour_rollup": render_per_hour_rollup}
+plot_titles = {"cumulative": "coffee count", "per_hour": "coffee consummation by time of day"}
+
+
+def warm_up_renderer():
+    """Imports the plotting modules in a render process."""
+    for module in ("stats", "matplotlib.figure"):
+        importlib.import_module(module)
+
+
+def warm_up():
+    """Starts the render processes and imports the plotting modules, so the first plot does not have to wait for it."""
+    logger.debug("warming up render processes")
+    pool = get_plot_pool()
+    for future in [pool.submit(warm_up_renderer) for _ in range(plot_workers)]:
+        future.result()
+    logger.debug("render processes ready")
+
+
+def render_plot(renderer, data, title):
+    """Renders a plot, called in a render process. Returns the PNG image (or None) and the seconds it took."""
+    start = time.perf_counter()
+    png = plot_renderers[renderer](data, title)
+    return png, time.perf_counter() - start
+
+
+'''
+Ingestion. Telegram delivers an update again if the web-hook call was slow or failed, so recently handled update ids are
+remembered. Changes arriving within coalesce_window are flushed to the storage at once, and the coffees and teas of
+that window are announced in one message per recipient.
+'''
+
+
+class UpdateWindow:
+    """Remembers the last `size` update ids."""
+    def __init__(self, size):
+        self.size = size
+        self.ids = set()
+        self.order = collections.deque()
+        self.lock = threading.Lock()
+
+    def seen(self, update_id):
+        """Returns True if the update id was seen before, otherwise remembers it."""
+        with self.lock:
+            if update_id in self.ids:
+                return True
+            self.ids.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.size:
+                self.ids.discard(self.order.popleft())
+            return False
+
+
+class Coalescer:
+    """
+    Collects changes of a group for `window` seconds after the first one, then flushes the storage and sends the
+    notifications about new coffees and teas.
+    """
+    def __init__(self, group, window):
+        self.group = group
+        self.window = window
+        self.lock = threading.Lock()
+        self.timer = None
+        self.events = {"coffee": [], "tea": []}  # ids of the users who added an event, in order
+
+    def changed(self):
+        """Schedules a flush at the end of the current window."""
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def added(self, kind, user_id):
+        """Schedules a notification about a new coffee or tea."""
+        with self.lock:
+            self.events[kind].append(user_id)
+        self.changed()
+
+    def flush(self):
+        """Flushes the storage and sends the collected notifications."""
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            events = self.events
+            self.events = {"coffee": [], "tea": []}
+        with self.group.lock, stage_seconds.time("flush"):
+            if self.group.storage is not None:
+                self.group.storage.flush()
+        for kind, user_ids in events.items():
+            if user_ids:
+                notify(self.group, kind, user_ids)
+
+
 '''
+Sessions: the state of a user's conversation with the bot (multi-step commands and the keyboard shown), which is not
+persisted. A session is dropped when the conversation returns to the default, so only users in the middle of something
+have one.
+'''
+
+
+class SessionStore:
+    """
+    Keeps the sessions in memory, at most max_entries of them (the least recently used ones are dropped first). A
+    session expires ttl seconds after it was set.
+    """
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> (expiry, value), least recently used first
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def get_many(self, keys):
+        """Returns the values of the given keys as list, None for missing ones."""
+        return [self.get(key) for key in keys]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+
+class RedisSessionStore:
+    """Keeps the sessions in redis (or a compatible server), shared by all processes. Redis expires them."""
+    def __init__(self, url, ttl):
+        import redis  # only needed with session_backend = "redis"
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get("coffeebot:session:" + key)
+        return None if value is None else value.decode()
+
+    def get_many(self, keys):
+        """Returns the values of the given keys as list, None for missing ones. Takes one round trip (MGET)."""
+        if not keys:
+            return []
+        values = self.client.mget(["coffeebot:session:" + key for key in keys])
+        return [None if value is None else value.decode() for value in values]
+
+    def set(self, key, value):
+        self.client.set("coffeebot:session:" + key, value, ex=self.ttl)
+
+    def delete(self, key):
+        self.client.delete("coffeebot:session:" + key)
+
+
+sessions = SessionStore(session_max_entries, session_ttl)  # replaced in start_serving with session_backend = "redis"
+
+
+def parse_session(session):
+    """Returns the state and keyboard of a stored session (None for no session)."""
+    if session is None:
+        return UserState.DEFAULT, Keyboard.DEFAULT
+    state, keyboard = session.split(",")
+    return UserState(int(state)), Keyboard(int(keyboard))
+
+
+def get_session(group, user_id):
+    """Returns the state and keyboard of a user."""
+    return parse_session(sessions.get(group.id + ":" + user_id))
+
+
+def get_sessions(group, user_ids):
+    """Returns the state and keyboard of several users as dictionary, with one lookup in the session store."""
+    user_ids = list(user_ids)
+    values = sessions.get_many([group.id + ":" + u for u in user_ids])
+    return {u: parse_session(value) for u, value in zip(user_ids, values)}
+
+
+def set_session(group, user_id, state=UserState.DEFAULT, keyboard=Keyboard.DEFAULT):
+    """Sets the state and keyboard of a user."""
+    if state == UserState.DEFAULT and keyboard == Keyboard.DEFAULT:
+        sessions.delete(group.id + ":" + user_id)
+    else:
+        sessions.set(group.id + ":" + user_id, "{0},{1}".format(state.value, keyboard.value))
 
 
-def store():
-    """Stores the current state (global users variable) to a JSON file."""
-    logger.debug("saving to file")
-    file_handle = open(state_file, "w+")
-    file_handle.write(json.dumps(users, cls=CoffeeJsonEncoder))
-    file_handle.close()
+'''
+Groups. Every group (coffee round) has its own bot, users, storage and cached output. The state of a group is loaded on
+first use and unloaded after group_idle_timeout seconds without use. With several worker processes, the groups are
+partitioned across them by a consistent hash of the group id.
+'''
 
 
-@app.route("/coffee/" + bot_id, methods=["POST"])
-def bot_request():
+class Group:
+    """
+    The state of a group. While a thread uses the group (with group: ...), it stays loaded.
+    The lock guards users and the persistence; all writes to the journal and the state file happen while holding it.
+    """
+    def __init__(self, group_id, bot_id, directory, admin_id="", admin_name="", log_access=False):
+        self.id = group_id
+        self.bot_id = bot_id
+        self.directory = directory
+        self.admin_id = admin_id  # added as admin if the group has no users
+        self.admin_name = admin_name
+        self.log_access = log_access  # whether the admins may get the log, which contains all groups of the process
+        self.lock = threading.RLock()
+        self.users = {}
+        self.storage = None  # None while the group is not loaded
+        self.state_version = 0  # incremented on every change of the state, used to invalidate cached output
+        self.closed_months_version = 0  # incremented on changes that can affect closed months (renames, new users, removals)
+        self.archived_version = 0  # state_version of the last archived snapshot
+        self.last_event = None  # time of the newest coffee or tea (0 if none), None until known; kept while unloaded
+        self.leaderboards = {}  # cached leaderboard texts: kind -> ((year, month), state_version, text)
+        self.recent_updates = UpdateWindow(update_window)
+        self.coalescer = Coalescer(self, coalesce_window)
+        self.active = 0  # number of threads using the group
+        self.last_used = time.monotonic()
+
+    def __enter__(self):
+        with self.lock:
+            if self.storage is None:
+                load(self)
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self.lock:
+            self.active -= 1
+            self.last_used = time.monotonic()
+
+
+class HashRing:
+    """Consistent hashing of group ids to workers: changing the number of workers only moves few groups."""
+    def __init__(self, workers, replicas=100):
+        self.points = sorted((hash_key("{0}:{1}".format(worker, i)), worker)
+                             for worker in range(workers) for i in range(replicas))
+        self.keys = [key for key, _ in self.points]
+
+    def worker(self, group_id):
+        return self.points[bisect.bisect(self.keys, hash_key(group_id)) % len(self.points)][1]
+
+
+def hash_key(text):
+    return int.from_bytes(hashlib.md5(text.encode("utf-8")).digest()[:8], "big")
+
+
+def read_groups():
     """
-    Handle web-hook calls form telegram API
+    Returns all configured groups. groups_file maps group ids to {"bot_id": ..., "admin_id": ..., "admin_name": ...,
+    "log_access": ...}. Without it, there is a single group configured by the settings.
+    """
+    if not os.path.exists(groups_file):
+        return [Group("default", bot_id, "", defautl_user_id, default_uesr_name, log_access=True)]
+    f = open(groups_file, "r")
+    configured = json.loads(f.read())
+    f.close()
+    return [Group(group_id, config["bot_id"], os.path.join(groups_directory, group_id), config.get("admin_id", ""),
+                  config.get("admin_name", ""), config.get("log_access", False))
+            for group_id, config in configured.items()]
+
+
+def register(group):
+    """Adds a group to the groups served by this process."""
+    groups[group.id] = group
+    groups_by_bot[group.bot_id] = group
+
+
+def unload(group):
+    """Persists and drops the state of a group, unless it is in use."""
+    group.coalescer.flush()
+    with group.lock:
+        if group.active > 0 or group.storage is None:
+            return
+        logger.info("unloading group %s", group.id)
+        group.storage.compact()
+        group.storage.close()
+        group.storage = None
+        group.users = {}
+        group.leaderboards = {}
+    plot_cache.drop(group.id)
+
+
+def archive_snapshots(stop):
+    """Archives a snapshot of every loaded group that changed since its last one, every snapshot_interval seconds."""
+    while not stop.wait(snapshot_interval):
+        for group in list(groups.values()):
+            with group.lock:
+                if group.storage is None or group.archived_version == group.state_version:
+                    continue
+                storage = group.storage
+                snapshot = storage.snapshot()
+                group.archived_version = group.state_version
+            # written without holding the lock, updates of the group do not wait for it
+            storage.write_snapshot(snapshot, archive=True)
+
+
+def schedule_digests(stop):
+    """
+    Sends the digests of all groups at the end of every hour, day and month, until stop is set. Groups without
+    coffees or teas since the start of a period are skipped without loading them.
+    """
+    end = None
+    while True:
+        now = datetime.datetime.now()
+        if end is not None and now < end:  # the wait may end slightly early
+            now = end
+        end = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+        if stop.wait((end - datetime.datetime.now()).total_seconds()):
+            return
+        for period in digest_periods:
+            start = digest_start(period, end)
+            if start is None:
+                continue
+            for group in list(groups.values()):
+                read_last_event(group)
+                if group.last_event is not None and group.last_event < to_timestamp(start):
+                    continue
+                try:
+                    send_digest(group, period, start, end)
+                except Exception:
+                    logger.exception("sending the %s digest of group %s failed", period, group.id)
+
+
+def read_last_event(group):
+    """Reads the time of the newest event of a group from its storage without loading the group, unless it is known."""
+    with group.lock:
+        if group.last_event is None:
+            group.last_event = create_storage(group.directory).read_last_event()
+
+
+def unload_idle_groups(stop):
+    """Unloads the groups which were not used for group_idle_timeout seconds, until stop is set."""
+    while not stop.wait(min(60, group_idle_timeout)):
+        for group in list(groups.values()):
+            if group.storage is not None and time.monotonic() - group.last_used > group_idle_timeout:
+                unload(group)
+
+
+'''
+Export of the state and the log ("get state", "get log"). Exports are read in chunks and compressed on the fly; exports
+larger than export_part_size are sent in several parts.
+'''
+log_time_pattern = re.compile(rb'^(?:\{"time": "([^"]+)"|\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d))')
+
+
+def period_bounds(text):
+    """Returns start and end (exclusive) of a month (2026-09) or day (2026-09-14) as datetimes."""
+    if re.match(r"^\d{4}-\d{2}$", text):
+        start = datetime.datetime.strptime(text, "%Y-%m")
+        return start, (start + datetime.timedelta(days=32)).replace(day=1)
+    start = datetime.datetime.strptime(text, "%Y-%m-%d")
+    return start, start + datetime.timedelta(days=1)
+
+
+def parse_period(tokens):
+    """
+    Parses the date range of an export: nothing (everything), a month or a day, or two of those (from the start of the
+    first to the end of the second). Returns start and end (exclusive), None if unbounded. Raises ValueError if invalid.
+    """
+    if not tokens:
+        return None, None
+    if len(tokens) > 2:
+        raise ValueError("too many dates")
+    first, last = period_bounds(tokens[0]), period_bounds(tokens[-1])
+    return first[0], last[1]
+
+
+def state_chunks(group, start, end):
+    """Yields the state (in the state file format) in chunks, with the events in [start, end) only."""
+    with group.lock:
+        exported = []
+        for user_id, user in group.users.items():
+            copy = User(user.name, user.role, user.updates_coffee, user.updates_tea, user.digest)
+            copy.coffees = group.storage.events(user_id, "coffee", start, end)
+            copy.teas = group.storage.events(user_id, "tea", start, end)
+            exported.append((user_id, copy))
+    yield '{"_type": "State", "seq": 0, "users": {'
+    for i, (user_id, user) in enumerate(exported):
+        yield (", " if i > 0 else "") + json.dumps(user_id) + ": " + json.dumps(user, cls=CoffeeJsonEncoder)
+    yield "}}"
+
+
+def log_line_time(line):
+    """Returns the time of a log line as ISO string, or None for lines without time (e.g. of tracebacks)."""
+    match = log_time_pattern.match(line)
+    if match is None:
+        return None
+    if match.group(1) is not None:
+        return match.group(1).decode()
+    return match.group(2).decode().replace(" ", "T")  # text format of older versions
+
+
+def log_offset(f, size, when):
+    """Returns the offset of the first line at or after `when` (ISO string) in an open log file, by binary search."""
+    def line_start(position):
+        if position == 0:
+            return 0
+        f.seek(position - 1)
+        f.readline()
+        return f.tell()
+
+    def at_or_after(position):
+        f.seek(line_start(position))
+        while f.tell() < size:
+            line_time = log_line_time(f.readline())
+            if line_time is not None:
+                return line_time >= when
+        return True
+
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        if at_or_after(middle):
+            high = middle
+        else:
+            low = middle + 1
+    return min(line_start(low), size)
+
+
+def log_files():
+    """Returns the log file and its rotated backups, oldest first."""
+    files = [log_file + "." + str(i) for i in range(log_backup_count, 0, -1)] + [log_file]
+    return [f for f in files if os.path.exists(f)]
+
+
+def log_chunks(start, end):
+    """Yields the lines of the log files in [start, end) in chunks."""
+    for path in log_files():
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        first = 0 if start is None else log_offset(f, size, start.isoformat())
+        last = size if end is None else log_offset(f, size, end.isoformat())
+        f.seek(first)
+        remaining = last - first
+        while remaining > 0:
+            chunk = f.read(min(export_chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+        f.close()
+
+
+def gzip_parts(chunks, part_size):
+    """
+    Compresses text or bytes chunks into temporary files of about part_size bytes at most (at least one), yielded at
+    their start; concatenated, they form a single gzip file. The caller closes them.
+    """
+    part = tempfile.TemporaryFile()
+    compressor = gzip.GzipFile(fileobj=part, mode="wb")
+    for chunk in chunks:
+        compressor.write(chunk.encode("utf-8") if isinstance(chunk, str) else chunk)
+        if part.tell() >= part_size:
+            compressor.close()
+            part.seek(0)
+            yield part
+            part = tempfile.TemporaryFile()
+            compressor = gzip.GzipFile(fileobj=part, mode="wb")
+    compressor.close()
+    part.seek(0)
+    yield part
+
+
+def send_part(group, to, name, part):
+    """Sends a file of an export and closes it once it is delivered. Returns whether it was."""
+    delivered = queue.SimpleQueue()
+    send_document(group, to, name, part, done=delivered.put)
+    try:
+        return delivered.get()
+    finally:
+        part.close()
+
+
+def send_export(group, to, name, chunks):
+    """
+    Sends the chunks compressed, as name.gz or as several parts if they are too large for a single document. Each part
+    is spooled to a temporary file and sent once the previous one is delivered.
+    """
+    with group:  # keeps the group loaded while its state is read and the keyboards are built
+        parts = 0
+        previous = None
+        for part in gzip_parts(chunks, export_part_size):
+            if previous is not None:
+                parts += 1
+                if not send_part(group, to, "{0}.part{1:03d}.gz".format(name, parts), previous):
+                    part.close()
+                    send_message(group, to, "Sending the export failed")
+                    return
+            previous = part
+        if parts == 0:
+            send_part(group, to, name + ".gz", previous)
+        else:
+            parts += 1
+            if send_part(group, to, "{0}.part{1:03d}.gz".format(name, parts), previous):
+                send_message(group, to, "The export was split into {0} parts, concatenate them to get the complete "
+                                        "file.".format(parts))
+            else:
+                send_message(group, to, "Sending the export failed")
+
+
+'''
+Application logic.
+'''
+
+
+def store(group):
+    """Compacts the current state of a group, e.g. into the state file."""
+    with group.lock, stage_seconds.time("store"):
+        logger.debug("saving to file")
+        group.storage.compact()
+
+
+def load(group):
+    """Loads the state of a group from its storage backend. A group without users gets its admin as first user."""
+    with group.lock:
+        logger.info("loading group %s", group.id)
+        group.storage = create_storage(group.directory)
+        group.users = group.storage.load()
+        group.last_event = group.storage.last_event()
+        if len(group.users) == 0 and group.admin_id:
+            logger.info("no users in group %s, adding %s as admin", group.id, group.admin_name)
+            commit(group, {"op": "addUser", "user_id": group.admin_id, "name": group.admin_name,
+                           "role": Role.admin.value})
+            store(group)
+        logger.info("Loaded %s: %s\n%s", group.id, current_state_coffee(group), current_state_tea(group))
+
+
+def commit(group, record):
+    """Applies a change to the current state and persists it. The record gets the commit time, see JsonStorage.restore."""
+    record["at"] = to_timestamp(datetime.datetime.now())
+    with group.lock:
+        group.storage.commit(record)
+        group.state_version += 1
+        if record["op"] in ("addCoffee", "addTea"):
+            group.last_event = max(group.last_event or 0, decode_time(record["time"]))
+        if record["op"] in ("addUser", "rename", "removeCoffee", "removeTea"):
+            group.closed_months_version += 1
+    group.coalescer.changed()
+
+
+def notify(group, kind, user_ids):
+    """
+    Tells every user with updates enabled who else had coffee (or tea), along with the current leaderboard. Users who
+    chose a digest get theirs from send_digest instead.
+    """
+    if kind == "coffee":
+        text = u"{0} just had coffee. And that is great.\n\n{1}"
+        state = current_state_coffee(group)
+    else:
+        text = u"{0} just had tea. And that is splendid.\n\n{1}"
+        state = current_state_tea(group)
+    messages = {}
+    for u in list(group.users):
+        user = group.users.get(u)
+        if user is None or user.digest is not None or not (user.updates_coffee if kind == "coffee" else user.updates_tea):
+            continue
+        names = []
+        for user_id in user_ids:
+            if user_id != u and user_id in group.users and group.users[user_id].name not in names:
+                names.append(group.users[user_id].name)
+        if names:
+            messages[u] = text.format(", ".join(names), state)
+    for u, reply_markup in create_keyboards(group, messages).items():
+        send_message(group, u, messages[u], reply_markup=reply_markup)
+
+
+def send_digest(group, period, start, end):
+    """
+    Sends every user with the given digest period one summary of the coffees and teas in [start, end) (datetimes). The
+    summary and the leaderboards are computed once and shared by all of them.
+    """
+    if period == "monthly":
+        title = start.strftime("in %B %Y")  # the summary is the final leaderboard of the month, the current one is empty
+    else:
+        title = "in the last hour" if period == "hourly" else "in the last day"
+    with group:
+        recipients = [u for u, user in list(group.users.items()) if user.digest == period]
+        if not recipients:
+            return
+        parts = {}
+        for kind, header, state in (("coffee", u"\u2615", current_state_coffee), ("tea", u"\U0001F375", current_state_tea)):
+            with group.lock:
+                counts = group.storage.event_counts(kind, to_timestamp(start), to_timestamp(end))
+                output = {group.users[u].name: c for u, c in counts.items() if u in group.users}
+            if output:
+                lines = [name + ": " + str(c) for (name, c) in sorted(output.items(), key=lambda x: -x[1])]
+                parts[kind] = header + " " + title + "\n" + "\n".join(lines)
+                if period != "monthly":
+                    parts[kind] += "\n\n" + state(group)
+        texts = {}  # by (updates_coffee, updates_tea)
+        messages = {}
+        for u in recipients:
+            user = group.users.get(u)
+            if user is None:
+                continue
+            kinds = tuple(kind for kind, enabled in (("coffee", user.updates_coffee), ("tea", user.updates_tea))
+                          if enabled and kind in parts)
+            if not kinds:
+                continue
+            if kinds not in texts:
+                texts[kinds] = "\n\n".join(parts[kind] for kind in kinds)
+            messages[u] = texts[kinds]
+        for u, reply_markup in create_keyboards(group, messages).items():
+            send_message(group, u, messages[u], reply_markup=reply_markup)
+            digests_total.inc(period)
+
+
+@app.route("/coffee/<token>", methods=["POST"])
+def bot_request(token):
+    """
+    Handle web-hook calls form telegram API, with a single update or a list of updates. The URL contains the bot id,
+    which selects the group. With several worker processes, the updates are passed on to the worker of the group.
     Returns empty responses to complete HTTP request. Answers are send via POSTS to API handles.
     """
-    logger.debug("got json: " + str(request.json))
-    message = request.json["message"]
+    group = groups_by_bot.get(token)
+    if group is None:
+        return Response(status=404)
+    updates = request.json
+    updates = updates if isinstance(updates, list) else [updates]
+    if worker_queues:
+        worker_queues[ring.worker(group.id)].put((group.id, updates))
+    else:
+        with group:
+            ingest(group, updates)
+    return Response()
+
+
+def ingest(group, updates):
+    """Handles a batch of updates in order, skipping updates that were handled before."""
+    for update in updates:
+        update_id = update.get("update_id")
+        if update_id is not None and group.recent_updates.seen(update_id):
+            logger.info("dropping duplicate update %s", update_id)
+            duplicate_updates_total.inc()
+            continue
+        try:
+            with update_seconds.time():
+                handle_update(group, update)
+        except Exception:
+            # one broken update must not keep the rest of the batch from being handled
+            logger.exception("handling update %s failed", update_id)
+            update_errors_total.inc()
+
+
+def handle_update(group, update):
+    """Executes the command in a single update."""
+    logger.debug("got update %s", update.get("update_id"), extra={"update": update})
+    message = update.get("message")
+    if message is None:
+        # edited messages, channel posts, ...
+        return
     user_id = str(message["from"]["id"])
 
-    if user_id not in users:
-        logger.info("unregistered userId: " + user_id)
+    user = group.users.get(user_id)
+    if user is None:
+        logger.info("unregistered userId: %s", user_id)
         # unregistered user - no response
-        return Response()
-
-    command, argument = parse_message(message, user_id)
-    users[user_id].state = UserState.DEFAULT
-    users[user_id].current_keyboard = Keyboard.DEFAULT
-    if not check_permissions(command, user_id):
-        # user does not have permission for command
-        logger.info("command not allowed: {0} by {1}".format(command, user_id))
-        send_message(user_id, "Command not allowed")
-        return Response()
-
-    execute_command(command, argument, user_id)
-    logger.debug("success command - responding")
-    return Response()
+        return
+
+    with user.lock:  # commands of one user are executed one after another, different users in parallel
+        state, keyboard = get_session(group, user_id)
+        with stage_seconds.time("parse"):
+            command, argument = parse_message(group, message, user_id, state)
+        commands_total.inc(command.name)
+        if state != UserState.DEFAULT or keyboard != Keyboard.DEFAULT:
+            set_session(group, user_id)  # back to the default, unless the command starts another conversation
+        if not check_permissions(group, command, user_id):
+            # user does not have permission for command
+            logger.info("command not allowed: %s by %s", command, user_id)
+            send_message(group, user_id, "Command not allowed")
+            return
+
+        with stage_seconds.time("execute"):
+            execute_command(group, command, argument, user_id)
+    logger.debug("success command")
+
+
+@metrics_app.route("/metrics")
+def metrics_request():
+    """Returns all metrics in the Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@metrics_app.route("/profile/<action>", methods=["POST"])
+def profile_request(action):
+    """Starts the sampling profiler, or stops it and returns the sampled stacks."""
+    if action == "start":
+        profiler.start()
+        return Response("profiler started\n", mimetype="text/plain")
+    elif action == "stop":
+        return Response(profiler.stop(), mimetype="text/plain")
+    return Response(status=404)
+
+
+def poll(group, stop):
+    """
+    Pulls updates with getUpdates long polling until stop is set, as alternative to the web-hook. Updates of one user
+    are handled in order, different users in parallel. The offset is stored with the state once the updates are handled.
+    The group is only loaded when there are updates.
+    """
+    session = requests.Session()
+    offset = create_storage(group.directory).read_offset()
+    logger.info("polling for updates of group %s from offset %s", group.id, offset)
+    failures = 0
+    while not stop.is_set():
+        try:
+            response = session.post(api_url + group.bot_id + "/getUpdates",
+                                    json={"offset": offset, "limit": poll_limit, "timeout": poll_timeout,
+                                          "allowed_updates": ["message"]},
+                                    timeout=poll_timeout + outbound_timeout)
+            result = response.json()
+        except (requests.RequestException, ValueError) as e:
+            result = {"ok": False, "description": str(e)}
+        if not result.get("ok"):
+            # e.g. 409 if a web-hook is set
+            logger.warning("getUpdates failed: %s", result.get("description"))
+            failures += 1
+            stop.wait(min(2 ** failures, 60))
+            continue
+        failures = 0
+        updates = result["result"]
+        if not updates:
+            continue
+        by_user = collections.OrderedDict()
+        for update in updates:
+            sender = update.get("message", {}).get("from", {}).get("id")
+            by_user.setdefault(sender, []).append(update)
+        offset = updates[-1]["update_id"] + 1
+        try:
+            with group:
+                list(poll_handlers.map(functools.partial(ingest, group), by_user.values()))
+                with group.lock:
+                    group.storage.set_offset(offset)
+            group.coalescer.changed()
+        except Exception:
+            # e.g. loading the group failed; the poller keeps running, the updates are skipped like failed updates
+            logger.exception("handling the updates of group %s failed", group.id)
+
+
+def send_message(group, to, text, keyboard=None, reply_markup=None):
+    """
+    Sends a message to the specified user. reply_markup is the serialized keyboard (see create_keyboards), by default
+    it is looked up for the user.
+    """
+    if reply_markup is None:
+        reply_markup = create_keyboard(group, to) if keyboard is None else json.dumps(keyboard)
+    data = {"chat_id": int(to), "text": text, "reply_markup": reply_markup}
+    logger.debug("sending message to %s", to, extra={"payload": data})
+    outbox.submit(group.bot_id, to, "sendMessage", data)
+
+
+def send_document(group, to, name, content, keyboard=None, done=None):
+    """
+    Send a document (file name and content as bytes or file object) to the specified user. done is passed on to
+    Outbox.submit.
+    """
+    reply_markup = create_keyboard(group, to) if keyboard is None else json.dumps(keyboard)
+    data = {"chat_id": int(to), "reply_markup": reply_markup}
+    size = len(content) if isinstance(content, bytes) else os.fstat(content.fileno()).st_size
+    logger.debug("sending file: %s (%s bytes)", name, size)
+    outbox.submit(group.bot_id, to, "sendDocument", data, files={"document": (name, content)}, done=done)
+
+
+def send_photo(group, to, name, plot, keyboard=None):
+    """Send a cached plot to the specified user. The image is only uploaded if telegram does not know it yet."""
+    reply_markup = create_keyboard(group, to) if keyboard is None else json.dumps(keyboard)
+    data = {"chat_id": int(to), "reply_markup": reply_markup}
+    if plot.file_id is not None:
+        logger.debug("sending photo: %s (file id %s)", name, plot.file_id)
+        data["photo"] = plot.file_id
+        outbox.submit(group.bot_id, to, "sendPhoto", data)
+    else:
+        logger.debug("sending photo: %s", name)
+        outbox.submit(group.bot_id, to, "sendPhoto", data, files={"photo": (name, plot.png)}, callback=plot.uploaded)
 
 
-def send_message(to, text, keyboard=None):
-    """Sends a message to the specified user."""
-    if keyboard is None:
-        keyboard = create_keyboard(to)
-    data = {"chat_id": int(to), "text": text, "reply_markup": json.dumps(keyboard)}
-    logger.debug("sending message: " + json.dumps(data))
-    response = requests.post(
-        url="https://api.telegram.org/" + bot_id + "/sendMessage", data=data)
-    logger.debug("got response from API: " + str(response.json()))
-
-
-def send_document(to, f, keyboard=None):
-    """Send a document (file path) to the specified user."""
-    if keyboard is None:
-        keyboard = create_keyboard(to)
-    document = open(f, "r+")
-    data = {"chat_id": int(to), "reply_markup": json.dumps(keyboard)}
-    logger.debug("sending file: " + f)
-    response = requests.post(
-        url="https://api.telegram.org/" + bot_id + "/sendDocument",
-        data=data, files={"document":  (file, document)})
-    logger.debug("got response from API: " + str(response.json()))
-    document.close()
-
-
-def send_photo(to, name, buf, keyboard=None):
-    if keyboard is None:
-        keyboard = create_keyboard(to)
-    """Send a photo from a byte buffer to the specified user."""
-    data = {"chat_id": int(to), "reply_markup": json.dumps(keyboard)}
-    logger.debug("sending photo: " + name)
-    response = requests.post(
-        url="https://api.telegram.org/" + bot_id + "/sendPhoto",
-        data=data, files={"photo":  (name, buf)})
-    logger.debug("got response from API: " + str(response.json()))
-
-
-def check_permissions(command, user_id):
+def check_permissions(group, command, user_id):
     """Checks whether the user can execute the given command."""
     if command in admin_commands:
-        return users[user_id].role == Role.admin
+        return group.users[user_id].role == Role.admin
     else:
         return True
 
 
-def parse_message(message, user_id):
-    """Extracts the command (and optionally arguments) from the current message."""
+def parse_message(group, message, user_id, state):
+    """Extracts the command (and optionally arguments) from the current message, given the state of the user."""
     command = Command.invalid
     argument = None
-    if users[user_id].state == UserState.DEFAULT:
+    if state == UserState.DEFAULT:
         if "text" in message:  # normal command
             text = message["text"]
             tokens = re.split("\s+", text)
@@ -309,21 +2215,24 @@ def parse_message(message, user_id):
         elif "contact" in message:  # user-add command
             command = Command.addUser
             argument = {"user_id": str(message["contact"]["user_id"]), "name": message["contact"]["first_name"]}
-    elif users[user_id].state == UserState.PLOT_CUMULATIVE_DATE_PICKER or \
-                    users[user_id].state == UserState.PLOT_PER_HOUR_DATE_PICKER:
+    elif state == UserState.PLOT_CUMULATIVE_DATE_PICKER or state == UserState.PLOT_PER_HOUR_DATE_PICKER:
         try:
             text = message["text"]
-            if users[user_id].state == UserState.PLOT_CUMULATIVE_DATE_PICKER:
+            if state == UserState.PLOT_CUMULATIVE_DATE_PICKER:
                 command = Command.plot_cumulative
-            elif users[user_id].state == UserState.PLOT_PER_HOUR_DATE_PICKER:
+            elif state == UserState.PLOT_PER_HOUR_DATE_PICKER:
                 command = Command.plot_per_hour
             if text == "All":
                 argument = "All"
             else:
-                argument = parser.parse(text)
+                try:
+                    argument = datetime.datetime.strptime(text, "%b %Y")  # as on the date chooser
+                except ValueError:
+                    from dateutil import parser
+                    argument = parser.parse(text)
         except:
-            logger.info("got unexpected error when parsing user plot command: {0}".format(sys.exc_info()[0]))
-    elif users[user_id].state == UserState.RENAME:
+            logger.info("got unexpected error when parsing user plot command: %s", sys.exc_info()[0])
+    elif state == UserState.RENAME:
         command = Command.rename_finish
         if "text" in message and len(message["text"]) > 0:
             argument = message["text"][:15]
@@ -333,259 +2242,521 @@ def parse_message(message, user_id):
     return command, argument
 
 
-def create_keyboard(user_id):
-    """Creates a keyboard for the given user at the current time."""
-    if users[user_id].current_keyboard == Keyboard.MORE:
-        return {"keyboard": [[u"-\u2615", u"-\U0001F375"], ["statistics", "rename"], ["back"]], "resize_keyboard": True}
-    elif users[user_id].current_keyboard == Keyboard.STATS:
+def build_keyboard(keyboard, updates_coffee, updates_tea, digest):
+    """Builds a keyboard (except the date chooser) for the given update settings."""
+    if keyboard == Keyboard.MORE:
+        return {"keyboard": [[u"-\u2615", u"-\U0001F375"], ["statistics", "rename"], ["digest [{0}]".format(digest or "off")],
+                             ["back"]], "resize_keyboard": True}
+    elif keyboard == Keyboard.STATS:
         return {"keyboard": [["plot cumulative count"], ["plot coffee per time of day"], ["back"]],
                 "resize_keyboard": True}
-    elif users[user_id].current_keyboard == Keyboard.STATS_DATE_CHOOSER:
-        current_month = datetime.date.today()
-        current_month = current_month.replace(day=1)
-        month_1_before = current_month - dateutil.relativedelta.relativedelta(months=1)
-        month_2_before = current_month - dateutil.relativedelta.relativedelta(months=2)
-        buttons = [["All"]] + map(lambda x: [x.strftime("%b %Y")], [current_month, month_1_before, month_2_before])\
-                  + [["back"]]
-        return {"keyboard": buttons, "resize_keyboard": True}
     else:  # Keyboard.DEFAULT or otherwise
-        if users[user_id].updates_coffee:
+        if updates_coffee:
             update_text_coffee = u"\u2615Updates [on]"
         else:
             update_text_coffee = u"\u2615Updates [off]"
-        if users[user_id].updates_tea:
+        if updates_tea:
             update_text_tea = u"\U0001F375Updates [on]"
         else:
             update_text_tea = u"\U0001F375Updates [off]"
         return {"keyboard": [[u"\u2615", u"\U0001F375"], [u"\u2615?", u"\U0001F375?"], [update_text_coffee, update_text_tea], ["more"]], "resize_keyboard": True}
 
 
-def current_state_coffee():
-    """Create a string with the current coffee counts."""
-    now = datetime.datetime.now()
-    output = {}
-    for user in users.values():
-        coffees = list(filter(lambda x: x.month == now.month and x.year == now.year, user.coffees))
-        output[user.name] = len(coffees)
-    lines = [name + ": "+str(c) for (name, c) in sorted(output.items(), key=lambda x: -x[1])]
-    return u"\u2615\n" + "\n".join(lines)
+# serialized keyboards by (keyboard, updates_coffee, updates_tea, digest)
+keyboard_markups = {(keyboard, updates_coffee, updates_tea, digest):
+                    json.dumps(build_keyboard(keyboard, updates_coffee, updates_tea, digest))
+                    for keyboard in Keyboard for updates_coffee in (False, True) for updates_tea in (False, True)
+                    for digest in (None,) + digest_periods}
+
+
+@functools.lru_cache(maxsize=2)
+def date_chooser_markup(current_month):
+    """Returns the serialized date chooser for the given month (first day) and the two months before."""
+    months = [current_month]
+    for _ in range(2):
+        months.append((months[-1] - datetime.timedelta(days=1)).replace(day=1))
+    buttons = [["All"]] + [[month.strftime("%b %Y")] for month in months] + [["back"]]
+    return json.dumps({"keyboard": buttons, "resize_keyboard": True})
+
+
+def keyboard_markup(user, keyboard):
+    """Returns the serialized keyboard for the given user and keyboard at the current time."""
+    if keyboard == Keyboard.STATS_DATE_CHOOSER:
+        return date_chooser_markup(datetime.date.today().replace(day=1))
+    return keyboard_markups[(keyboard, bool(user.updates_coffee), bool(user.updates_tea), user.digest)]
 
 
-def current_state_tea():
+def create_keyboard(group, user_id):
+    """Returns the serialized keyboard for the given user at the current time."""
+    _, keyboard = get_session(group, user_id)
+    return keyboard_markup(group.users[user_id], keyboard)
+
+
+def create_keyboards(group, user_ids):
+    """
+    Returns the serialized keyboards of several users (e.g. the recipients of a notification) as dictionary, with one
+    lookup in the session store instead of one per user.
+    """
+    return {u: keyboard_markup(group.users[u], keyboard) for u, (_, keyboard) in get_sessions(group, user_ids).items()
+            if u in group.users}
+
+
+def leaderboard(group, kind, header):
+    """
+    Create a string with the counts of the current month, sorted by count.
+    The text is cached until the state changes or a new month starts.
+    """
+    now = datetime.datetime.now()
+    month = (now.year, now.month)
+    with group.lock:
+        cached = group.leaderboards.get(kind)
+        if cached is not None and cached[0] == month and cached[1] == group.state_version:
+            return cached[2]
+        output = {}
+        for user_id, user in group.users.items():
+            output[user.name] = group.storage.month_count(user_id, kind, *month)
+        lines = [name + ": " + str(c) for (name, c) in sorted(output.items(), key=lambda x: -x[1])]
+        text = header + "\n" + "\n".join(lines)
+        group.leaderboards[kind] = (month, group.state_version, text)
+        return text
+
+
+def current_state_coffee(group):
     """Create a string with the current coffee counts."""
+    return leaderboard(group, "coffee", u"\u2615")
+
+
+def current_state_tea(group):
+    """Create a string with the current tea counts."""
+    return leaderboard(group, "tea", u"\U0001F375")
+
+
+def plot_cache_key(group, plot, argument):
+    """
+    Returns the cache key for a plot of the given date range and whether the plot can be pinned.
+    Plots of closed months only change on renames, new users and removals, so they are keyed by the version of those.
+    """
+    if argument == "All":
+        return (group.id, plot, "All", group.state_version), False
+    month = (argument.year, argument.month)
     now = datetime.datetime.now()
-    output = {}
-    for user in users.values():
-        teas = list(filter(lambda x: x.month == now.month and x.year == now.year, user.teas))
-        output[user.name] = len(teas)
-    lines = [name + ": " + str(t) for (name, t) in sorted(output.items(), key=lambda x: -x[1])]
-    return u"\U0001F375\n" + "\n".join(lines)
+    if month < (now.year, now.month):
+        return (group.id, plot, month, group.closed_months_version), True
+    return (group.id, plot, month, group.state_version), False
+
 
+def plot_data(group, plot, argument):
+    """
+    Returns the renderer and the data of a plot, to be sent to a render process. Plots of a month get the coffees of
+    all users in the month, as (name, events) pairs. Plots of all time are computed from the rollups, so they do not get
+    more expensive as the history grows: the cumulative plot gets at most plot_points points per user, the per-hour
+    plot the number of coffees per hour of the week.
+    """
+    with group.lock:
+        if argument != "All":
+            start, end = month_bounds(argument.year, argument.month)
+            return plot, [(user.name, group.storage.events(user_id, "coffee", start, end))
+                          for user_id, user in group.users.items()]
+        if plot == "per_hour":
+            data = []
+            for user_id, user in group.users.items():
+                counts = group.storage.rollup(user_id, "coffee", "weekday_hour")
+                data.append((user.name, [counts.get(bucket, 0) for bucket in range(7 * 24)]))
+            return "per_hour_rollup", data
+        # the finest period that spans the whole history with at most plot_points buckets
+        months = [month for user_id in group.users for month in group.storage.rollup(user_id, "coffee", "month")]
+        days = 0
+        if months:
+            days = (bucket_start("month", max(months) + 1) - bucket_start("month", min(months))) // DAY
+        period = "day" if days <= plot_points else "week" if days // 7 + 1 <= plot_points else "month"
+        return "cumulative_rollup", [(user.name,) + cumulative_series(group.storage.rollup(user_id, "coffee", period),
+                                                                      period, plot_points)
+                                     for user_id, user in group.users.items()]
+
+
+def cumulative_series(counts, period, points):
+    """
+    Turns the counts per bucket of a rollup into the times (bucket starts) and cumulative counts of at most `points`
+    buckets; every n-th bucket is kept, always including the last one.
+    """
+    buckets = sorted(counts)
+    totals = list(itertools.accumulate(counts[bucket] for bucket in buckets))
+    step = max(1, -(-len(buckets) // points))
+    kept = range(len(buckets) - 1, -1, -step)[::-1]
+    return array("q", (bucket_start(period, buckets[i]) for i in kept)), array("q", (totals[i] for i in kept))
+
+
+def get_plot_pool():
+    """Returns the process pool for rendering plots, starting it on first use and again after it broke."""
+    global plot_pool
+    with plot_lock:
+        if plot_pool is None:
+            plot_pool = ProcessPoolExecutor(max_workers=plot_workers, mp_context=multiprocessing.get_context("spawn"))
+        return plot_pool
+
+
+def discard_plot_pool(pool):
+    """
+    Drops a broken process pool (e.g. a render process was killed), so that get_plot_pool starts a new one. Otherwise
+    every later plot would fail.
+    """
+    global plot_pool
+    with plot_lock:
+        if plot_pool is not pool:
+            return  # already replaced
+        plot_pool = None
+    logger.warning("a render process died, restarting the render processes")
+    pool.shutdown(wait=False)
+
+
+def send_plot(group, to, plot, argument, name):
+    """
+    Sends a plot to the specified user. Plots which are not cached yet are rendered in the background and delivered once
+    they are done. Concurrent requests for the same plot share one rendering.
+    """
+    key, pinned = plot_cache_key(group, plot, argument)
+    cached = plot_cache.get(key)
+    if cached is not None:
+        send_photo(group, to, name, cached)
+        return
+    with plot_lock:
+        if key in rendering:
+            rendering[key].append(to)
+            return
+        rendering[key] = [to]
+    if argument == "All":
+        title = plot_titles[plot]
+    else:
+        title = plot_titles[plot] + " in " + argument.strftime("%B %Y")
+    pool = None
+    try:
+        renderer, data = plot_data(group, plot, argument)  # outside of plot_lock, other groups do not wait for it
+        pool = get_plot_pool()
+        future = pool.submit(render_plot, renderer, data, title)
+    except Exception as e:
+        logger.exception("rendering %s failed", key)
+        if isinstance(e, BrokenProcessPool):
+            discard_plot_pool(pool)
+        plot_done(group, key, name, None, "Rendering the plot failed, please try again")
+        return
+    future.add_done_callback(functools.partial(plot_rendered, group, key, pinned, name, pool))
+
+
+def plot_rendered(group, key, pinned, name, pool, future):
+    """Caches a rendered plot and sends it to everybody who requested it."""
+    try:
+        png, seconds = future.result()
+        render_seconds.observe(seconds, key[1])
+    except Exception as e:
+        logger.exception("rendering %s failed", key)
+        if isinstance(e, BrokenProcessPool):
+            discard_plot_pool(pool)
+        plot_done(group, key, name, None, "Rendering the plot failed, please try again")
+        return
+    cached = None
+    if png is not None:
+        cached = plot_cache.put(key, png, pinned)
+    plot_done(group, key, name, cached, "on data for the given time interval")
+
+
+def plot_done(group, key, name, cached, text):
+    """Sends a rendered plot (or the text if there is none) to everybody waiting for it."""
+    with plot_lock:
+        recipients = rendering.pop(key)
+    with group:  # the keyboards need the users
+        for to in recipients:
+            if cached is not None:
+                send_photo(group, to, name, cached)
+            else:
+                send_message(group, to, text)
 
-def execute_command(command, argument, user_id):
+
+def execute_command(group, command, argument, user_id):
     """Execute the given commands."""
     if command == Command.addCoffee:
-        logger.debug("Executing 'addCoffee' for " + user_id)
-        users[user_id].add_coffee()
-        store()
+        logger.debug("Executing 'addCoffee' for %s", user_id)
+        commit(group, {"op": "addCoffee", "user_id": user_id, "time": to_timestamp(datetime.datetime.now())})
         phrase = random.choice(coffee_response_phrases)
-        send_message(user_id, phrase + "\n\n" + current_state_coffee())
-        for u in users:  # send updates
-            update_text = u"{0} just had coffee. And that is great.\n\n{1}".format(users[user_id].name, current_state_coffee())
-            if u != user_id and users[u].updates_coffee:
-                send_message(u, update_text)
+        state = current_state_coffee(group)
+        send_message(group, user_id, phrase + "\n\n" + state)
+        group.coalescer.added("coffee", user_id)
     elif command == Command.removeCoffee:
-        logger.debug("Removing last coffee for " + user_id)
-        users[user_id].remove_last_coffee()
-        store()
-        send_message(user_id, current_state_coffee())
+        logger.debug("Removing last coffee for %s", user_id)
+        commit(group, {"op": "removeCoffee", "user_id": user_id})
+        send_message(group, user_id, current_state_coffee(group))
     elif command == Command.addTea:
-        logger.debug("Executing 'addTea' for " + user_id)
-        users[user_id].add_tea()
-        store()
+        logger.debug("Executing 'addTea' for %s", user_id)
+        commit(group, {"op": "addTea", "user_id": user_id, "time": to_timestamp(datetime.datetime.now())})
         phrase = random.choice(tea_response_phrases)
-        send_message(user_id, phrase + "\n\n" + current_state_tea())
-        for u in users:  # send updates
-            update_text = u"{0} just had tea. And that is splendid.\n\n{1}".format(users[user_id].name, current_state_tea())
-            if u != user_id and users[u].updates_tea:
-                send_message(u, update_text)
+        state = current_state_tea(group)
+        send_message(group, user_id, phrase + "\n\n" + state)
+        group.coalescer.added("tea", user_id)
     elif command == Command.removeTea:
-        logger.debug("Removing last tea for " + user_id)
-        users[user_id].remove_last_tea()
-        store()
-        send_message(user_id, current_state_tea())
+        logger.debug("Removing last tea for %s", user_id)
+        commit(group, {"op": "removeTea", "user_id": user_id})
+        send_message(group, user_id, current_state_tea(group))
     elif command == Command.currentStateCoffee:
-        logger.debug("Executing 'currentStateCoffee' for " + user_id)
-        send_message(user_id, current_state_coffee())
+        logger.debug("Executing 'currentStateCoffee' for %s", user_id)
+        send_message(group, user_id, current_state_coffee(group))
     elif command == Command.currentStateTea:
-        logger.debug("Executing 'currentStateTea' for " + user_id)
-        send_message(user_id, current_state_tea())
+        logger.debug("Executing 'currentStateTea' for %s", user_id)
+        send_message(group, user_id, current_state_tea(group))
     elif command == Command.changeUpdateSettingTea:
-        logger.debug("Executing 'changeUpdateTea: {0}' for {1}".format(argument, user_id))
+        logger.debug("Executing 'changeUpdateTea: %s' for %s", argument, user_id)
         if argument == "[off]":
-            users[user_id].updates_tea = True
-            send_message(user_id, "Tea updates enabled")
+            commit(group, {"op": "updatesTea", "user_id": user_id, "value": True})
+            send_message(group, user_id, "Tea updates enabled")
         elif argument == "[on]":
-            users[user_id].updates_tea = False
-            send_message(user_id, "Tea updates disabled")
-        store()
+            commit(group, {"op": "updatesTea", "user_id": user_id, "value": False})
+            send_message(group, user_id, "Tea updates disabled")
     elif command == Command.changeUpdateSettingCoffee:
-        logger.debug("Executing 'changeUpdateCoffee: {0}' for {1}".format(argument, user_id))
+        logger.debug("Executing 'changeUpdateCoffee: %s' for %s", argument, user_id)
         if argument == "[off]":
-            users[user_id].updates_coffee = True
-            send_message(user_id, "Coffee updates enabled")
+            commit(group, {"op": "updatesCoffee", "user_id": user_id, "value": True})
+            send_message(group, user_id, "Coffee updates enabled")
         elif argument == "[on]":
-            users[user_id].updates_coffee = False
-            send_message(user_id, "Coffee updates disabled")
-        store()
+            commit(group, {"op": "updatesCoffee", "user_id": user_id, "value": False})
+            send_message(group, user_id, "Coffee updates disabled")
+    elif command == Command.changeDigestSetting:
+        logger.debug("Executing 'changeDigest: %s' for %s", argument, user_id)
+        settings = ("off",) + digest_periods
+        setting = argument.strip("[]") if argument is not None else None
+        if setting not in settings:
+            send_message(group, user_id, "use e.g. \"digest daily\" (hourly, daily, monthly or off)")
+            return
+        if argument.startswith("["):  # the button showing the current setting switches to the next one
+            setting = settings[(settings.index(setting) + 1) % len(settings)]
+        commit(group, {"op": "digest", "user_id": user_id, "value": None if setting == "off" else setting})
+        if setting == "off":
+            send_message(group, user_id, "Digest disabled, updates are sent right away")
+        else:
+            send_message(group, user_id, "Updates are sent as {0} digest".format(setting))
     elif command == Command.addUser:
-        logger.debug("Executing 'addUser: {0}' for {1}".format(argument, user_id))
-        users[argument["user_id"]] = User(argument["name"])
-        store()
-        send_message(argument["user_id"], "You have been added to the cofeebot")
-        for u in users:
-            if u != argument["user_id"]:
-                send_message(u, "Successfully added {0} to the Bot. Welcome!".format(argument["name"]))
+        logger.debug("Executing 'addUser: %s' for %s", argument, user_id)
+        commit(group, {"op": "addUser", "user_id": argument["user_id"], "name": argument["name"]})
+        send_message(group, argument["user_id"], "You have been added to the cofeebot")
+        others = [u for u in list(group.users) if u != argument["user_id"]]
+        for u, reply_markup in create_keyboards(group, others).items():
+            send_message(group, u, "Successfully added {0} to the Bot. Welcome!".format(argument["name"]),
+                         reply_markup=reply_markup)
     elif command == Command.moreKeyboard:
-        logger.debug("setting keyboard to more for " + user_id)
-        users[user_id].current_keyboard = Keyboard.MORE
-        send_message(user_id, "showing more option")
+        logger.debug("setting keyboard to more for %s", user_id)
+        set_session(group, user_id, keyboard=Keyboard.MORE)
+        send_message(group, user_id, "showing more option")
     elif command == Command.backKeyboard:
-        logger.debug("setting keyboard to default for " + user_id)
-        users[user_id].current_keyboard = Keyboard.DEFAULT
-        send_message(user_id, "back to default menu")
+        logger.debug("setting keyboard to default for %s", user_id)
+        set_session(group, user_id)
+        send_message(group, user_id, "back to default menu")
     elif command == Command.statisticsKeyboard:
-        logger.debug("setting keyboard to stats for " + user_id)
-        users[user_id].current_keyboard = Keyboard.STATS
-        send_message(user_id, "statistics")
+        logger.debug("setting keyboard to stats for %s", user_id)
+        set_session(group, user_id, keyboard=Keyboard.STATS)
+        send_message(group, user_id, "statistics")
     elif command == Command.rename_start:
-        logger.debug("initiating rename for " + user_id)
-        users[user_id].current_keyboard = Keyboard.DEFAULT
-        users[user_id].state = UserState.RENAME
-        send_message(user_id, "please enter the new name", {"remove_keyboard": True})
+        logger.debug("initiating rename for %s", user_id)
+        set_session(group, user_id, UserState.RENAME)
+        send_message(group, user_id, "please enter the new name", {"remove_keyboard": True})
     elif command == Command.rename_finish:
-        logger.debug("finishing rename for " + user_id + "to " + argument)
-        users[user_id].name = argument
-        store()
-        send_message(user_id, "renamed to " + argument)
+        logger.debug("finishing rename for %s to %s", user_id, argument)
+        commit(group, {"op": "rename", "user_id": user_id, "name": argument})
+        send_message(group, user_id, "renamed to " + argument)
     elif command == Command.broadcast:
-        logger.info("sending broadcast " + argument)
-        for u in users:
-            send_message(u, argument)
+        logger.info("sending broadcast %s", argument)
+        for u, reply_markup in create_keyboards(group, list(group.users)).items():
+            send_message(group, u, argument, reply_markup=reply_markup)
     elif command == Command.getFile:
-        if argument == "state":
+        tokens = argument.split() if argument is not None else []
+        try:
+            start, end = parse_period(tokens[1:])
+        except ValueError:
+            send_message(group, user_id, "invalid date range, use e.g. \"get log 2026-09\" or \"get state 2026-01 2026-06\"")
+            return
+        suffix = "".join("-" + token for token in tokens[1:])
+        # exports are compressed in the background, the user's further commands do not have to wait for them
+        if tokens and tokens[0] == "state":
             logger.debug("sending state file")
-            send_document(user_id, state_file)
-        elif argument == "log":
+            chunks = state_chunks(group, None if start is None else to_timestamp(start),
+                                  None if end is None else to_timestamp(end))
+            threading.Thread(target=send_export, args=(group, user_id, "state" + suffix + ".json", chunks), name="export",
+                             daemon=True).start()
+        elif tokens and tokens[0] == "log" and not group.log_access:
+            send_message(group, user_id, "The log contains other groups as well and cannot be sent")
+        elif tokens and tokens[0] == "log":
             logger.debug("sending log file")
-            send_document(user_id, log_file)
+            base, extension = os.path.splitext(os.path.basename(log_file))
+            threading.Thread(target=send_export, args=(group, user_id, base + suffix + extension, log_chunks(start, end)),
+                             name="export", daemon=True).start()
     elif command == Command.plot:
         if argument.startswith("cumulative"):
-            logger.debug("setting plot mode to cumulative; displaying date picker for " + user_id)
-            users[user_id].state = UserState.PLOT_CUMULATIVE_DATE_PICKER
-            users[user_id].current_keyboard = Keyboard.STATS_DATE_CHOOSER
-            send_message(user_id, "please specify the data range")
+            logger.debug("setting plot mode to cumulative; displaying date picker for %s", user_id)
+            set_session(group, user_id, UserState.PLOT_CUMULATIVE_DATE_PICKER, Keyboard.STATS_DATE_CHOOSER)
+            send_message(group, user_id, "please specify the data range")
         elif argument.startswith("coffee"):
-            logger.debug("setting plot mode to cumulative; displaying date picker for " + user_id)
-            users[user_id].state = UserState.PLOT_PER_HOUR_DATE_PICKER
-            users[user_id].current_keyboard = Keyboard.STATS_DATE_CHOOSER
-            send_message(user_id, "please specify the data range")
+            logger.debug("setting plot mode to cumulative; displaying date picker for %s", user_id)
+            set_session(group, user_id, UserState.PLOT_PER_HOUR_DATE_PICKER, Keyboard.STATS_DATE_CHOOSER)
+            send_message(group, user_id, "please specify the data range")
         else:
-            logger.debug("invalid plot mode ({0}); resetting to default".format(argument))
-            users[user_id].current_keyboard = Keyboard.DEFAULT
-            send_message(user_id, "invalid selection")
+            logger.debug("invalid plot mode (%s); resetting to default", argument)
+            set_session(group, user_id)
+            send_message(group, user_id, "invalid selection")
     elif command == Command.plot_cumulative:
-        logger.debug("Creating cumulative plot, argument: {0}".format(argument))
-        any_data = False
-        figure = plt.figure(figsize=(8.5, 6))
-        for u in users:
-            name = users[u].name
-            if argument == "All":
-                coffees = users[u].coffees
-            else:
-                coffees = list(filter(lambda x: x.month == argument.month and x.year == argument.year, users[u].coffees))
-            count = [1] * len(coffees)
-            count = np.cumsum(count)
-            ser = pd.Series(count, coffees)
-            if len(ser) > 0:
-                ser.plot(label=name)
-                any_data = True
-        if any_data:
-            handles, labels = figure.axes[0].get_legend_handles_labels()
-            figure.axes[0].legend(handles[::-1], labels[::-1], bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
-            if argument == "All":
-                figure.axes[0].set_title("coffee counts over time")
-            else:
-                figure.axes[0].set_title("coffee count in {0}".format(argument.strftime("%B %Y")))
-            figure.axes[0].set(ylabel='#coffees')
-            figure.axes[0].set(xlabel='date')
-
-            figure.subplots_adjust(right=0.8, bottom=0.2)
-
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png')
-            buf.seek(0)
-            send_photo(user_id, "coffee_count.png", buf)
-            buf.close()
-        else:
-            send_message(user_id, "on data for the given time interval")
+        logger.debug("Creating cumulative plot, argument: %s", argument)
+        send_plot(group, user_id, "cumulative", argument, "coffee_count.png")
     elif command == Command.plot_per_hour:
-        logger.debug("Creating per hour plot, argument: {0}".format(argument))
-        any_data = False
-        figure = plt.figure(figsize=(8.5,6))
-        for u in users:
-            name = users[u].name
-            weekday = []
-            time = []
-            if argument == "All":
-                coffees = users[u].coffees
-            else:
-                coffees = list(filter(lambda x: x.month == argument.month and x.year == argument.year, users[u].coffees))
-            if len(coffees) > 0:
-                any_data = True
-                for c in users[u].coffees:
-                    weekday.append(c.weekday())
-                    time.append(c.hour + c.minute/60.0 + c.second/(60.0*60.0))
-                plt.scatter(weekday, time, marker="x", label=name)
-        if any_data:
-            handles, labels = figure.axes[0].get_legend_handles_labels()
-            figure.axes[0].legend(handles[::-1], labels[::-1], bbox_to_anchor=(1.05, 1), loc=2, borderaxespad=0.)
-            if argument == "All":
-                figure.axes[0].set_title("coffee consummation by time of day")
-            else:
-                figure.axes[0].set_title("coffee consummation by time of day in {0}".format(argument.strftime("%B %Y")))
-            figure.axes[0].set(ylabel="time of day")
-            figure.axes[0].set(xlabel="day of week")
-            figure.axes[0].set_ylim([0, 23])
-            plt.xticks(range(7), ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'], rotation='vertical')
-            plt.yticks(range(24), range(24))
-            plt.gca().invert_yaxis()
-
-            figure.subplots_adjust(right=0.8, bottom=0.2)
-
-            buf = io.BytesIO()
-            plt.savefig(buf, format='png')
-            buf.seek(0)
-            send_photo(user_id, "coffee_per_hour.png", buf)
-            buf.close()
-        else:
-            send_message(user_id, "on data for the given time interval")
+        logger.debug("Creating per hour plot, argument: %s", argument)
+        send_plot(group, user_id, "per_hour", argument, "coffee_per_hour.png")
     else:
         pass
 
 
+def restore(group, when):
+    """Restores the state of a group as of the given timestamp."""
+    storage = create_storage(group.directory)
+    taken, replayed = storage.restore(when)
+    storage.close()
+    logger.info("restored group %s as of %s from the snapshot of %s and %s journal records", group.id,
+                from_timestamp(when), from_timestamp(taken), replayed)
+
+
+def serve(group, updates):
+    """Handles a batch of updates of a group, loading the group if needed."""
+    with group:
+        ingest(group, updates)
+
+
+def start_metrics_server(port):
+    server = make_server("127.0.0.1", port, metrics_app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+
+def start_serving(poll_mode, stop):
+    """
+    Starts the background threads of this process: the janitor unloading idle groups, the digest scheduler, the archiving
+    of snapshots and, if polling, the pollers. Connects to redis for the sessions, if configured.
+    """
+    global sessions
+    if session_backend == "redis":
+        sessions = RedisSessionStore(redis_url, session_ttl)
+    threading.Thread(target=unload_idle_groups, args=(stop,), name="janitor", daemon=True).start()
+    threading.Thread(target=schedule_digests, args=(stop,), name="digests", daemon=True).start()
+    if snapshot_interval is not None:
+        threading.Thread(target=archive_snapshots, args=(stop,), name="snapshots", daemon=True).start()
+    if warm_up_delay is not None:
+        warm_up_timer = threading.Timer(warm_up_delay, warm_up)
+        warm_up_timer.daemon = True
+        warm_up_timer.start()
+    pollers = []
+    if poll_mode:
+        for group in groups.values():
+            poller = threading.Thread(target=poll, args=(group, stop), name="poll-" + group.id)
+            poller.start()
+            pollers.append(poller)
+    return pollers
+
+
+def stop_serving(stop, pollers):
+    """Stops polling, waits for pending plots, persists and unloads all groups and delivers the remaining messages."""
+    stop.set()
+    for poller in pollers:
+        poller.join()  # a poller notices stop once its current getUpdates call returns
+    if plot_pool is not None:
+        plot_pool.shutdown(wait=True)
+    for group in list(groups.values()):
+        unload(group)
+    outbox.close()
+
+
+def run_worker(index, workers, poll_mode, updates):
+    """
+    Runs in worker process `index` of `workers`, serving the groups the hash ring assigns to it. Handles the updates the
+    frontend puts on the queue, or polls the updates of its groups, until None is put on the queue.
+    """
+    global ring
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the frontend shuts the workers down
+    base, extension = os.path.splitext(log_file)
+    setup_logging("{0}.worker{1}{2}".format(base, index, extension))
+    ring = HashRing(workers)
+    for group in read_groups():
+        if ring.worker(group.id) == index:
+            register(group)
+    logger.info("worker %s serving groups: %s", index, ", ".join(groups))
+    if metrics_port is not None:
+        start_metrics_server(metrics_port + 1 + index)
+    stop = threading.Event()
+    pollers = start_serving(poll_mode, stop)
+    handlers = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="worker")
+    while True:
+        item = updates.get()
+        if item is None:
+            break
+        group_id, batch = item
+        handlers.submit(serve, groups[group_id], batch)
+    handlers.shutdown(wait=True)
+    stop_serving(stop, pollers)
+    logger.info("worker %s stopped", index)
+
+
 '''
 Start Application
 '''
 
 if __name__ == "__main__":
-    if os.path.exists(state_file):  # if state file exist load
-        logger.info("Found existing state file. Loading.")
-        f = open(state_file, "r+")
-        users = json.loads(f.read(), cls=CoffeeJsonDecoder)
-        f.close()
-        logger.info("Loaded: " + current_state_coffee() + "\n" +current_state_tea())
-    else:  # else add default user as admin and create new user list
-        users[defautl_user_id] = User(default_uesr_name, Role.admin)
-    app.run(port=8080, debug=False)
-    store()
+    argument_parser = argparse.ArgumentParser(description="coffeebot server")
+    argument_parser.add_argument("--poll", action="store_true",
+                                 help="pull updates with getUpdates long polling instead of serving the web-hook")
+    argument_parser.add_argument("--workers", type=int, default=group_workers,
+                                 help="number of worker processes the groups are partitioned across")
+    argument_parser.add_argument("--restore", metavar="TIME",
+                                 help="restore the state as of the given time (e.g. \"2026-10-01 12:00\") and exit; "
+                                      "the server must not be running")
+    argument_parser.add_argument("--group", help="the group to restore, if several groups are configured")
+    arguments = argument_parser.parse_args()
+    setup_logging(log_file)
+    if arguments.restore is not None:
+        try:
+            when = to_timestamp(datetime.datetime.fromisoformat(arguments.restore))
+        except ValueError:
+            argument_parser.error("invalid time: " + arguments.restore)
+        restored = [group for group in read_groups() if arguments.group in (None, group.id)]
+        if len(restored) != 1:
+            argument_parser.error("specify one of the groups with --group")
+        try:
+            restore(restored[0], when)
+        except ValueError as e:
+            argument_parser.error(str(e))
+        sys.exit(0)
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    for group in read_groups():
+        register(group)
+    if arguments.workers > 1:
+        # this process only receives the web-hook calls and passes the updates on to the worker of their group
+        ring = HashRing(arguments.workers)
+        context = multiprocessing.get_context("spawn")
+        worker_queues = [context.Queue() for _ in range(arguments.workers)]
+        processes = [context.Process(target=run_worker, args=(i, arguments.workers, arguments.poll, worker_queues[i]),
+                                     name="worker-{0}".format(i)) for i in range(arguments.workers)]
+        for process in processes:
+            process.start()
+        try:
+            if arguments.poll:
+                for process in processes:
+                    process.join()
+            else:
+                app.run(port=8080, debug=False, threaded=True)
+        except KeyboardInterrupt:
+            pass
+        for worker_queue in worker_queues:
+            worker_queue.put(None)
+        for process in processes:
+            process.join()
+    else:
+        stop = threading.Event()
+        pollers = start_serving(arguments.poll, stop)
+        if arguments.poll:
+            try:
+                stop.wait()
+            except KeyboardInterrupt:
+                logger.info("stopped polling")
+        else:
+            app.run(port=8080, debug=False, threaded=True)
+        stop_serving(stop, pollers)
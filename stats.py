@@ -0,0 +1,39 @@
+'''
+Vectorized statistics over event arrays.
+
+Events are timestamps in microseconds since the epoch (local time, see server.to_timestamp), sorted in chronological
+order. They can be given as array('q') or numpy int64 arrays; array('q') is viewed without copying.
+'''
+import numpy as np
+
+a_monday = np.datetime64("1969-12-29", "D")
+
+
+def as_array(events):
+    """Returns the events as numpy int64 array, without copying."""
+    if isinstance(events, np.ndarray):
+        return events
+    return np.frombuffer(events, dtype=np.int64)
+
+
+def times(events):
+    """Returns the events as numpy datetime64 array, without copying."""
+    return as_array(events).view("datetime64[us]")
+
+
+def cumulative_counts(events):
+    """Returns the number of events up to and including each event."""
+    return np.arange(1, len(events) + 1)
+
+
+def weekday_and_hour(events):
+    """Returns the day of week (Monday is 0) and the time of day in (fractional) hours of each event."""
+    events = times(events)
+    days = events.astype("datetime64[D]")
+    return (days - a_monday).astype(np.int64) % 7, (events - days) / np.timedelta64(1, "h")
+
+
+def weekday_hour_counts(events):
+    """Returns the number of events per hour of the week (weekday * 24 + hour, Monday is 0), as array of 7 * 24 counts."""
+    weekdays, hours = weekday_and_hour(events)
+    return np.bincount(weekdays * 24 + hours.astype(np.int64), minlength=7 * 24)